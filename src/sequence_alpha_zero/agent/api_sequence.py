@@ -1,4 +1,5 @@
 from connect4_zero.config import Config
+from connect4_zero.env.features import PLANE_SHAPE
 
 
 class Connect4ModelAPI:
@@ -7,13 +8,13 @@ class Connect4ModelAPI:
         self.agent_model = agent_model
 
     def predict(self, x):
-        # Ensure the input has 4 channels (one for each feature: board, hand, discard, opponent belief)
-        assert x.ndim == 4  # x should have the shape (batch_size, 10, 10, 4)
-        assert x.shape[1:] == (10, 10, 4)  # 10x10 board and 4 channels for other features
+        # Planes written by connect4_zero.env.features.encode_observation
+        assert x.ndim == 4  # x should have the shape (batch_size,) + PLANE_SHAPE
+        assert x.shape[1:] == PLANE_SHAPE
 
         orig_x = x
         if x.ndim == 3:
-            x = x.reshape(1, 10, 10, 4)  # Adjust shape for Sequence input
+            x = x.reshape((1,) + PLANE_SHAPE)  # Adjust shape for Sequence input
 
         # Run the prediction
         policy, value = self.agent_model.model.predict_on_batch(x)
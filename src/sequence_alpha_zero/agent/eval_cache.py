@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from logging import getLogger
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+
+class EvaluationCache:
+    """LRU cache of network evaluations keyed by (observation key, model digest)
+
+    Keys come from features.observation_key(), which pins both the network
+    input and the legal actions. Only the priors of the legal actions are
+    kept, in the order of np.flatnonzero(env.legal_action_mask()). Entries
+    are evicted least recently used first once `max_bytes` is exceeded.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (key, digest) -> (priors, value)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, digest):
+        """(legal priors, value) or None; models without a digest are never cached"""
+        if digest is None:
+            return None
+        entry = self.entries.get((key, digest))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end((key, digest))
+        self.hits += 1
+        return entry
+
+    def put(self, key, digest, priors, value):
+        if digest is None or (key, digest) in self.entries:
+            return
+        priors = np.asarray(priors, dtype=np.float32)
+        self.entries[(key, digest)] = (priors, float(value))
+        self.nbytes += self.entry_bytes(priors)
+        while self.nbytes > self.max_bytes and self.entries:
+            _, (old_priors, _) = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_bytes(old_priors)
+            self.evictions += 1
+
+    @staticmethod
+    def entry_bytes(priors):
+        return priors.nbytes + 64  # rough cost of the key tuple and dict slot
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return (f"entries={len(self.entries)} bytes={self.nbytes} hits={self.hits} misses={self.misses} "
+                f"hit_rate={self.hit_rate()*100:.1f}% evictions={self.evictions}")
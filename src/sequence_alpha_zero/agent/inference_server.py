@@ -0,0 +1,130 @@
+import os
+from logging import getLogger
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+from time import time
+
+import numpy as np
+
+from connect4_zero.agent.api_sequence import Connect4ModelAPI
+from connect4_zero.config import Config
+from connect4_zero.lib import tf_util
+from connect4_zero.lib.model_helpler import load_best_model_weight, reload_best_model_weight_if_changed
+
+logger = getLogger(__name__)
+
+
+def start_inference_server(config: Config, client_num):
+    """Start the best model in its own process, serving `client_num` clients
+
+    :return: (server process, list of InferenceClient, one per worker)
+    """
+    pipes = [Pipe() for _ in range(client_num)]
+    process = Process(target=serve, args=(config, [server_conn for server_conn, _ in pipes]),
+                      name="inference_server", daemon=True)
+    process.start()
+    for server_conn, _ in pipes:
+        server_conn.close()  # only the server process keeps these ends
+    return process, [InferenceClient(client_conn) for _, client_conn in pipes]
+
+
+def serve(config: Config, conns):
+    from connect4_zero.agent.model_sequence import SequenceModel
+    tf_util.set_session_config(per_process_gpu_memory_fraction=0.4)
+    model = SequenceModel(config)
+    if not load_best_model_weight(model):
+        raise RuntimeError("Best model can not loaded!")
+    InferenceServer(config, model, conns).run()
+
+
+class InferenceClient:
+    """Drop-in for Connect4ModelAPI that forwards predictions to the inference server
+
+    Requests are tagged with (pid, counter) so a worker restarted on the same
+    pipe skips replies meant for the process it replaced.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.request_num = 0
+
+    def predict(self, x):
+        self.request_num += 1
+        request_id = (os.getpid(), self.request_num)
+        self.conn.send((request_id, x))
+        while True:
+            reply_id, policy, value = self.conn.recv()
+            if reply_id == request_id:
+                return policy, value
+
+    def close(self):
+        self.conn.send(None)
+        self.conn.close()
+
+
+class InferenceServer:
+    """Batches prediction requests across every connected process
+
+    After the first request arrives, requests from other clients are
+    gathered until inference_batch_size states are queued or
+    inference_max_latency_sec has passed, then one predict_on_batch serves
+    all of them. The best model weights are reloaded when they change.
+    """
+
+    def __init__(self, config: Config, model, conns):
+        self.config = config
+        self.model = model
+        self.api = Connect4ModelAPI(config, model)
+        self.conns = list(conns)
+        self.last_reload_check = time()
+
+    def run(self):
+        pc = self.config.play
+        while self.conns:
+            self.reload_model_if_changed()
+            ready = wait(self.conns, timeout=pc.model_reload_interval_sec)
+            requests = self.receive(ready)
+            if not requests:
+                continue
+            deadline = time() + pc.inference_max_latency_sec
+            while sum(len(x) for _, _, x in requests) < pc.inference_batch_size and self.conns:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                ready = wait(self.conns, timeout=remaining)
+                if not ready:
+                    break
+                requests += self.receive(ready)
+            self.predict(requests)
+        logger.debug("all inference clients closed")
+
+    def receive(self, ready):
+        requests = []
+        for conn in ready:
+            try:
+                request = conn.recv()
+            except EOFError:
+                request = None
+            if request is None:
+                self.conns.remove(conn)
+                conn.close()
+            else:
+                request_id, x = request
+                requests.append((conn, request_id, x))
+        return requests
+
+    def predict(self, requests):
+        data = np.concatenate([x for _, _, x in requests])
+        policy_ary, value_ary = self.api.predict(data)
+        start = 0
+        for conn, request_id, x in requests:
+            end = start + len(x)
+            conn.send((request_id, policy_ary[start:end], value_ary[start:end]))
+            start = end
+
+    def reload_model_if_changed(self):
+        if time() - self.last_reload_check < self.config.play.model_reload_interval_sec:
+            return
+        self.last_reload_check = time()
+        if reload_best_model_weight_if_changed(self.model):
+            logger.debug(f"reloaded best model, digest={self.model.digest}")
@@ -0,0 +1,204 @@
+from logging import getLogger
+
+import numpy as np
+
+from connect4_zero.agent.mcts_tree import MCTSTree, select_puct_batch
+from connect4_zero.config import Config
+from connect4_zero.env.features import PLANE_SHAPE, encode_observation, observation_record
+from connect4_zero.env.sequence_env import SequenceEnv, Winner, Player
+from connect4_zero.env.vec_env import SequenceVecEnv
+
+logger = getLogger(__name__)
+
+
+class GameSlot:
+    """One self-play game driven by LockstepPlayer, with its own search tree"""
+
+    def __init__(self, config: Config, play_config, env: SequenceEnv):
+        self.config = config
+        self.play_config = play_config
+        self.env = env  # the position of this game in LockstepPlayer.games
+        self.tree = MCTSTree(play_config.tree_node_capacity, play_config.tree_edge_capacity)
+        self.moves = [[], []]  # per agent id: [observation, policy, z]
+        self.search_env = None  # root clone walked with push()/pop()
+        self.path = []  # edges taken by the running simulation
+        self.simulation_num = 0
+        self.root_p = None
+        self.reset(env)
+
+    def reset(self, env: SequenceEnv):
+        """Start a new game from `env`"""
+        self.env = env
+        self.tree.clear()
+        self.moves = [[], []]
+        self.start_move()
+
+    def start_move(self):
+        if not self.tree.has_room(self.play_config.simulation_num_per_move):
+            self.tree.clear()
+        self.search_env = self.env.clone()
+        self.path = []
+        self.simulation_num = 0
+        self.root_p = None
+
+    def counter_key(self):
+        return self.search_env.zobrist_key(include_hand=True)
+
+    def finish_game(self):
+        if self.env.winner == Winner.blue:
+            blue_win = 1
+        elif self.env.winner == Winner.red:
+            blue_win = -1
+        else:
+            blue_win = 0
+        for move in self.moves[0]:
+            move += [blue_win]
+        for move in self.moves[1]:
+            move += [-blue_win]
+
+
+class LockstepPlayer:
+    """Advances the MCTS of many games together, one simulation per game per tick
+
+    Every tick descends one simulation in each game up to a leaf (selection
+    for all games at the same depth is one select_puct_batch call), evaluates
+    all the leaves in a single network call, then backs the values up. Batch
+    size is the number of games instead of parallel_search_num. The games
+    themselves live in a SequenceVecEnv, and the moves chosen in a tick are
+    played in one step of it.
+    """
+
+    def __init__(self, config: Config, api, game_num, play_config=None):
+        self.config = config
+        self.api = api
+        self.play_config = play_config or config.play
+        self.labels_n = config.n_labels
+        # the games themselves, stepped together; each slot searches a SequenceEnv copy of its game
+        self.games = SequenceVecEnv(game_num, seed=np.random.randint(2 ** 31))
+        self.slots = [GameSlot(config, self.play_config, self.games.to_env(i)) for i in range(game_num)]
+        self.input_buffer = np.zeros((game_num,) + PLANE_SHAPE, dtype=np.float32)  # a leaf per game at most
+
+    def run(self, on_game_end):
+        """Play forever, calling on_game_end(slot) before each slot starts a new game"""
+        while True:
+            self.tick(on_game_end)
+
+    def tick(self, on_game_end):
+        leaves = self.select_leaves()
+        if leaves:
+            for i, (slot, _) in enumerate(leaves):
+                encode_observation(slot.search_env, out=self.input_buffer[i])
+            policy_ary, value_ary = self.api.predict(self.input_buffer[:len(leaves)])
+            for (slot, key), leaf_p, leaf_v in zip(leaves, policy_ary, value_ary):
+                self.expand(slot, key, leaf_p)
+                leaf_v = float(leaf_v)
+                if slot.search_env.player_turn() == Player.red:
+                    leaf_v = -leaf_v  # Value for blue == -Value for red
+                self.backup(slot, leaf_v)
+
+        ready = [i for i, slot in enumerate(self.slots)
+                 if slot.simulation_num >= self.play_config.simulation_num_per_move]
+        if ready:
+            self.play_moves(ready, on_game_end)
+
+    def select_leaves(self):
+        """Descend every game to a leaf; returns [(slot, leaf key)] still needing evaluation"""
+        pc = self.play_config
+        leaves = []
+        active = self.slots
+        while active:
+            selecting = []
+            for slot in active:
+                env = slot.search_env
+                if env.done:
+                    self.backup(slot, {Winner.blue: 1, Winner.red: -1}.get(env.winner, 0))
+                    continue
+                key = slot.counter_key()
+                node = slot.tree.get(key)
+                if not slot.tree.is_expanded(node):
+                    leaves.append((slot, key))
+                    continue
+                sl = slot.tree.children(node)
+                if sl.start == sl.stop:  # no legal move: a draw, see SequenceEnv.mover_stuck()
+                    self.backup(slot, 0)
+                    continue
+                selecting.append((slot, sl))
+            if not selecting:
+                break
+
+            n, q, p, signs = [], [], [], []
+            for slot, sl in selecting:
+                tree = slot.tree
+                p_ = tree.p[sl]
+                if not slot.path:  # root: Dirichlet noise drawn once per move
+                    if slot.root_p is None:
+                        slot.root_p = (1 - pc.noise_eps) * p_ + \
+                            pc.noise_eps * np.random.dirichlet([pc.dirichlet_alpha] * len(p_))
+                    p_ = slot.root_p
+                n.append(tree.n[sl])
+                q.append(tree.q[sl])
+                p.append(p_)
+                signs.append(1 if slot.search_env.player_turn() == Player.blue else -1)
+            counts = [len(x) for x in n]
+            chosen = select_puct_batch(np.concatenate(n), np.concatenate(q), np.concatenate(p),
+                                       counts, pc.c_puct, np.array(signs))
+            offset = 0
+            for (slot, sl), count, idx in zip(selecting, counts, chosen):
+                edge = sl.start + int(idx) - offset
+                offset += count
+                slot.path.append(edge)
+                slot.search_env.push(int(slot.tree.action[edge]))
+            active = [slot for slot, _ in selecting]
+        return leaves
+
+    @staticmethod
+    def expand(slot, key, leaf_p):
+        node = slot.tree.add_node(key)  # -1 if the pool is full: evaluate only
+        if node < 0:
+            return
+        legal_actions = np.flatnonzero(slot.search_env.legal_action_mask())
+        if not slot.tree.expand(node, legal_actions, leaf_p[legal_actions]):
+            slot.tree.remove_node(key)
+
+    @staticmethod
+    def backup(slot, leaf_v):
+        tree = slot.tree
+        for edge in reversed(slot.path):
+            slot.search_env.pop()
+            tree.n[edge] += 1
+            tree.w[edge] += leaf_v
+            tree.q[edge] = tree.w[edge] / tree.n[edge]
+        slot.path = []
+        slot.simulation_num += 1
+
+    def play_moves(self, indices, on_game_end):
+        """Play the searched move of the games at `indices` in one SequenceVecEnv step"""
+        actions = [self.choose_move(self.slots[i]) for i in indices]
+        self.games.step(actions, indices)
+        for i in indices:
+            slot = self.slots[i]
+            slot.env = self.games.to_env(i)
+            if slot.env.done:  # won, out of cards, or the next mover is stuck (drawn)
+                slot.finish_game()
+                on_game_end(slot)
+                self.games.reset([i])
+                slot.reset(self.games.to_env(i))
+            else:
+                slot.start_move()
+
+    def choose_move(self, slot):
+        """Action picked from the root visits of `slot`, recorded in its moves"""
+        env = slot.env
+        node = slot.tree.get(env.zobrist_key(include_hand=True))
+        if not slot.tree.is_expanded(node):
+            raise RuntimeError(f"the root of game turn {env.turn} was never expanded, the search tree is too small")
+        var_n = slot.tree.dense(node, slot.tree.n, self.labels_n)
+        if env.turn < self.play_config.change_tau_turn:
+            policy = var_n / np.sum(var_n)  # tau = 1
+        else:
+            policy = np.zeros(self.labels_n)  # tau = 0
+            policy[np.argmax(var_n)] = 1
+        action = int(np.random.choice(range(self.labels_n), p=policy))
+
+        slot.moves[env.state.current_player].append([observation_record(env), list(policy)])
+        return action
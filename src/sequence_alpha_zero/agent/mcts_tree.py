@@ -0,0 +1,202 @@
+from logging import getLogger
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+EXPANDING = 1
+EXPANDED = 2
+EDGES_PER_NODE_RESERVE = 64  # edges kept free per simulation still to run
+
+
+class MCTSTree:
+    """Node pool for MCTS with statistics in preallocated contiguous arrays
+
+    Nodes are looked up by position key. An expanded node owns a contiguous
+    slice of the edge arrays holding one edge per legal action, so the
+    statistics of a node with k legal moves cost k entries instead of a
+    dense array over the whole action space.
+
+    Positions reached by different move orders share one node, so the
+    tree is really a DAG. Following UCT3, each node keeps its own value
+    (the network evaluation averaged with its children's values, weighted
+    by edge visits) and each edge links to its child node. The Q of an edge
+    is the value of the child it leads to, whichever parent backed it up.
+    """
+
+    def __init__(self, node_capacity, edge_capacity):
+        self.node_capacity = node_capacity
+        self.edge_capacity = edge_capacity
+
+        self.node_state = np.zeros(node_capacity, dtype=np.int8)
+        self.edge_start = np.zeros(node_capacity, dtype=np.int64)
+        self.edge_count = np.zeros(node_capacity, dtype=np.int32)
+        self.node_v = np.zeros(node_capacity, dtype=np.float32)  # network evaluation, blue's view
+        self.node_q = np.zeros(node_capacity, dtype=np.float32)
+
+        self.action = np.zeros(edge_capacity, dtype=np.int32)
+        self.n = np.zeros(edge_capacity, dtype=np.float32)
+        self.w = np.zeros(edge_capacity, dtype=np.float32)
+        self.q = np.zeros(edge_capacity, dtype=np.float32)
+        self.p = np.zeros(edge_capacity, dtype=np.float32)
+        self.child = np.full(edge_capacity, -1, dtype=np.int32)  # node id, -1 if unknown or terminal
+
+        self.nodes = {}  # key -> node id
+        self.node_num = 0
+        self.edge_num = 0
+
+    def clear(self):
+        """Drop every node, keeping the allocated arrays for reuse"""
+        self.nodes.clear()
+        self.node_state[:self.node_num] = 0
+        self.node_num = 0
+        self.edge_num = 0
+
+    def retain(self, keys):
+        """Keep only the nodes of `keys`, e.g. the subtree under a new root, compacting both pools
+
+        Nodes are renumbered in the order of `keys` and their edges moved to
+        the front of the edge arrays, so the freed space is reusable at once.
+        """
+        old = np.array([self.nodes[key] for key in keys], dtype=np.int64)
+        m = len(old)
+        state = self.node_state[old]
+        start = self.edge_start[old]
+        count = self.edge_count[old]
+        new_start = np.concatenate([[0], np.cumsum(count)[:-1]]).astype(np.int64)
+        total = int(np.sum(count))
+        src = np.repeat(start - new_start, count) + np.arange(total)
+        for ary in (self.action, self.n, self.w, self.q, self.p, self.child):
+            ary[:total] = ary[src]
+        renumber = np.full(self.node_capacity + 1, -1, dtype=np.int32)  # index -1 keeps -1
+        renumber[old] = np.arange(m)
+        self.child[:total] = renumber[self.child[:total]]
+        node_v = self.node_v[old]
+        node_q = self.node_q[old]
+
+        self.node_state[:self.node_num] = 0
+        self.node_state[:m] = state
+        self.edge_start[:m] = new_start
+        self.edge_count[:m] = count
+        self.node_v[:m] = node_v
+        self.node_q[:m] = node_q
+        self.nodes = {key: i for i, key in enumerate(keys)}
+        self.node_num = m
+        self.edge_num = total
+
+    def free_nodes(self):
+        return self.node_capacity - self.node_num
+
+    def free_edges(self):
+        return self.edge_capacity - self.edge_num
+
+    def has_room(self, simulation_num):
+        """True if `simulation_num` more simulations, each adding at most one node, fit in both pools"""
+        return self.free_nodes() >= simulation_num and \
+            self.free_edges() >= simulation_num * EDGES_PER_NODE_RESERVE
+
+    def get(self, key):
+        """Node id of `key` or -1"""
+        return self.nodes.get(key, -1)
+
+    def add_node(self, key):
+        """Register `key` as being expanded; returns its node id, or -1 if the pool is full"""
+        if self.node_num >= self.node_capacity:
+            return -1
+        node = self.node_num
+        self.node_num += 1
+        self.nodes[key] = node
+        self.node_state[node] = EXPANDING
+        self.edge_count[node] = 0
+        return node
+
+    def expand(self, node, actions, priors, value=0):
+        """Attach one edge per legal action; returns False if the edge pool is full
+
+        :param value: network evaluation of the node for blue
+        """
+        k = len(actions)
+        if self.edge_num + k > self.edge_capacity:
+            return False
+        start = self.edge_num
+        end = start + k
+        self.edge_num = end
+        self.edge_start[node] = start
+        self.edge_count[node] = k
+        self.action[start:end] = actions
+        self.p[start:end] = priors
+        self.n[start:end] = 0
+        self.w[start:end] = 0
+        self.q[start:end] = 0
+        self.child[start:end] = -1
+        self.node_v[node] = value
+        self.node_q[node] = value
+        self.node_state[node] = EXPANDED
+        return True
+
+    def remove_node(self, key):
+        """Forget a node whose expansion could not be completed"""
+        node = self.nodes.pop(key)
+        self.node_state[node] = 0
+
+    def is_expanded(self, node):
+        return node >= 0 and self.node_state[node] == EXPANDED
+
+    def is_expanding(self, node):
+        return node >= 0 and self.node_state[node] == EXPANDING
+
+    def children(self, node):
+        """Slice of the edge arrays belonging to `node`"""
+        if node < 0:  # get() of an unknown key; a negative index would read the last slot
+            raise IndexError(f"node {node} is not in the tree")
+        start = self.edge_start[node]
+        return slice(start, start + self.edge_count[node])
+
+    def edge_q(self, sl):
+        """Q of the edges in `sl`: the shared child value where known, else the edge's own mean"""
+        child = self.child[sl]
+        return np.where(child >= 0, self.node_q[child], self.q[sl])
+
+    def update_node_q(self, node):
+        """UCT3 backup: node value = (evaluation + sum of n * child Q) / (1 + sum of n)"""
+        sl = self.children(node)
+        n = self.n[sl]
+        self.node_q[node] = (self.node_v[node] + np.dot(n, self.edge_q(sl))) / (1 + np.sum(n))
+
+    def dense(self, node, values, size):
+        """Scatter per-edge `values` of `node` into a dense array over all actions"""
+        ret = np.zeros(size)
+        sl = self.children(node)
+        ret[self.action[sl]] = values[sl]
+        return ret
+
+    def memory_usage(self):
+        """Bytes held by the preallocated arrays"""
+        arrays = [self.node_state, self.edge_start, self.edge_count, self.node_v, self.node_q,
+                  self.action, self.n, self.w, self.q, self.p, self.child]
+        return sum(a.nbytes for a in arrays)
+
+
+def select_puct(n, q, p, c_puct, sign=1):
+    """Index of the child maximizing sign*Q + U over one node's child arrays"""
+    xx_ = max(np.sqrt(np.sum(n)), 1)  # avoid u_=0 if N is all 0
+    return int(np.argmax(sign * q + c_puct * p * xx_ / (1 + n)))
+
+
+def select_puct_batch(n, q, p, counts, c_puct, signs):
+    """select_puct for many nodes (of one or many trees) in one pass
+
+    :param n, q, p: child arrays of every node concatenated
+    :param counts: number of children per node, all > 0
+    :param signs: +1/-1 per node, the Q sign for the player to move
+    :return: index into the concatenated arrays of the chosen child of each node
+    """
+    counts = np.asarray(counts)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    seg = np.repeat(np.arange(len(counts)), counts)
+    xx_ = np.maximum(np.sqrt(np.add.reduceat(n, starts)), 1)
+    scores = np.repeat(signs, counts) * q + c_puct * p * xx_[seg] / (1 + n)
+    best = np.maximum.reduceat(scores, starts)
+    hits = np.flatnonzero(scores == best[seg])
+    _, first = np.unique(seg[hits], return_index=True)  # first maximum, like argmax
+    return hits[first]
@@ -13,6 +13,7 @@ from keras.losses import mean_squared_error
 from keras.regularizers import l2
 
 from connect4_zero.config import Config
+from connect4_zero.env.features import PLANE_SHAPE
 
 logger = getLogger(__name__)
 
@@ -24,9 +25,7 @@ class SequenceModel:
 
     def build(self):
         # Input for the board, hand, and opponent’s belief
-        in_x = x = Input(
-            (10, 10, 4)
-        )  # Updated for Sequence (10x10 board + hand, discard, belief)
+        in_x = x = Input(PLANE_SHAPE)  # see connect4_zero.env.features for the planes
 
         # Convolutional layers for board processing
         x = Conv2D(filters=128, kernel_size=3, padding="same", activation="relu")(x)
@@ -37,7 +36,9 @@ class SequenceModel:
         y = Dense(256, activation="relu")(x)
 
         # Policy head (outputs probabilities for each action)
-        policy_out = Dense(104, activation="softmax", name="policy_out")(y)
+        policy_out = Dense(
+            self.config.n_labels, activation="softmax", name="policy_out"
+        )(y)
 
         # Value head (outputs game outcome prediction)
         value_out = Dense(1, activation="tanh", name="value_out")(y)
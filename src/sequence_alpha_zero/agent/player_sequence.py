@@ -1,186 +1,350 @@
-from _asyncio import Future
-from asyncio.queues import Queue
-from collections import defaultdict, namedtuple
+from asyncio import Future
+from collections import Counter, namedtuple
 from logging import getLogger
 import asyncio
 
 import numpy as np
 
-from connect4_zero.agent.api_connect4 import Connect4ModelAPI
+from connect4_zero.agent.api_sequence import Connect4ModelAPI
+from connect4_zero.agent.mcts_tree import MCTSTree, select_puct
 from connect4_zero.config import Config
-from connect4_zero.env.sequence_env import Connect4Env, Winner, Player
+from connect4_zero.env.features import PLANE_SHAPE, encode_observation, observation_key, observation_record
+from connect4_zero.env.sequence_env import SequenceEnv, Winner, Player, decode_action
 
-CounterKey = namedtuple("CounterKey", "board next_player")
 QueueItem = namedtuple("QueueItem", "state future")
 HistoryItem = namedtuple("HistoryItem", "action policy values visit")
 
 logger = getLogger(__name__)
 
+class BatchStats:
+    """Histograms of prediction batch sizes and of how long the first request waited"""
+
+    def __init__(self):
+        self.batch_size_hist = Counter()
+        self.latency_hist = Counter()  # bucket: latency in microseconds rounded up to a power of 2
+        self.wakeups = 0
+
+    def record(self, batch_size, latency_sec):
+        self.batch_size_hist[batch_size] += 1
+        self.latency_hist[1 << int(latency_sec * 1e6).bit_length()] += 1
+
+    def __str__(self):
+        batches = sum(self.batch_size_hist.values())
+        items = sum(k * v for k, v in self.batch_size_hist.items())
+        mean = items / batches if batches else 0
+        return (f"batches={batches} mean_size={mean:.2f} wakeups={self.wakeups} "
+                f"sizes={dict(sorted(self.batch_size_hist.items()))} "
+                f"latency_us={dict(sorted(self.latency_hist.items()))}")
+
 
 class Connect4Player:
-    def __init__(self, config: Config, model, play_config=None):
+    def __init__(self, config: Config, model, play_config=None, api=None, cache=None):
+        """
 
+        :param api: prediction backend, e.g. an InferenceClient; defaults to running `model` in-process
+        :param connect4_zero.agent.eval_cache.EvaluationCache|None cache: evaluations shared across
+            players and games, keyed by the digest of `model`
+        """
         self.config = config
         self.model = model
         self.play_config = play_config or self.config.play
-        self.api = Connect4ModelAPI(self.config, self.model)
+        self.api = api or Connect4ModelAPI(self.config, self.model)
+        self.cache = cache
 
         self.labels_n = config.n_labels
-        self.var_n = defaultdict(lambda: np.zeros((self.labels_n,)))
-        self.var_w = defaultdict(lambda: np.zeros((self.labels_n,)))
-        self.var_q = defaultdict(lambda: np.zeros((self.labels_n,)))
-        self.var_u = defaultdict(lambda: np.zeros((self.labels_n,)))
-        self.var_p = defaultdict(lambda: np.zeros((self.labels_n,)))
-        self.expanded = set()
-        self.now_expanding = set()
-        self.prediction_queue = Queue(self.play_config.prediction_queue_size)
+        self.tree = MCTSTree(self.play_config.tree_node_capacity, self.play_config.tree_edge_capacity)
         self.sem = asyncio.Semaphore(self.play_config.parallel_search_num)
 
         self.moves = []
         self.loop = asyncio.get_event_loop()
         self.running_simulation_num = 0
 
+        # prediction batching: requests wait in pending_predictions until every
+        # active simulation is either queued or blocked, or the deadline passes
+        self.pending_predictions = []  # type: list[QueueItem]
+        self.flush_event = asyncio.Event()
+        self.flush_deadline = None
+        self.search_done = False
+        self.active_search_num = 0
+        self.blocked_search_num = 0
+        self.expanding = {}  # key -> Future resolved once the node is expanded
+        self.batch_stats = BatchStats()
+        # network input of the pending predictions; at most one per running simulation
+        self.input_buffer = np.zeros((self.play_config.parallel_search_num,) + PLANE_SHAPE, dtype=np.float32)
+        self.first_request_time = 0
+        self.env_pool = []  # one mutable env per parallel search
+        self.root_env = None  # position being searched; ISMCTS samples determinizations of it
+        self.observer = None  # agent id of this player, whose information sets key the tree in ISMCTS
+        self.root_p = None  # root priors with Dirichlet noise, drawn once per search
+
         self.thinking_history = {}  # for fun
 
-    def action(self, board):
+    def action(self, env: SequenceEnv):
 
-        env = Connect4Env().update(board)
+        self.observer = env.state.current_player
         key = self.counter_key(env)
+        tree = self.tree
+        pc = self.play_config
+        if pc.ismcts:
+            tree.clear()  # hidden-card draws rarely match the real ones, so nothing is worth keeping
+        elif pc.reuse_tree:
+            self.reuse_subtree(env)  # advance through the opponent's move
+        # each simulation adds at most one node; keep room for a whole search
+        needed = pc.simulation_num_per_move * pc.thinking_loop
+        if not tree.has_room(needed):
+            logger.debug(f"search tree full ({tree.memory_usage()} bytes), clearing it")
+            tree.clear()
 
         for tl in range(self.play_config.thinking_loop):
             if tl > 0 and self.play_config.logging_thinking:
-                logger.debug(f"continue thinking: policy move=({action % 8}, {action // 8}), "
-                             f"value move=({action_by_value % 8}, {action_by_value // 8})")
-            self.search_moves(board)
-            policy = self.calc_policy(board)
+                logger.debug(f"continue thinking: policy move={decode_action(action)}, "
+                             f"value move={decode_action(action_by_value)}")
+            self.search_moves(env)
+            policy = self.calc_policy(env)
             action = int(np.random.choice(range(self.labels_n), p=policy))
-            action_by_value = int(np.argmax(self.var_q[key] + (self.var_n[key] > 0)*100))
+            node = tree.get(key)
+            sl = tree.children(node)
+            action_by_value = int(tree.action[sl][np.argmax(tree.edge_q(sl) + (tree.n[sl] > 0)*100)])
             if action == action_by_value or env.turn < self.play_config.change_tau_turn:
                 break
 
         # this is for play_gui, not necessary when training.
-        self.thinking_history[env.observation] = HistoryItem(action, policy, list(self.var_q[key]), list(self.var_n[key]))
-
-        self.moves.append([env.observation, list(policy)])
+        self.thinking_history[env.observation] = HistoryItem(
+            action, policy,
+            list(tree.dense(node, tree.q, self.labels_n)),
+            list(tree.dense(node, tree.n, self.labels_n)))
+
+        self.moves.append([observation_record(env), list(policy)])
+        if pc.reuse_tree and not pc.ismcts:
+            env = env.clone()
+            env.push(action)
+            self.reuse_subtree(env)  # drop the sibling subtrees right away
         return action
 
+    def reuse_subtree(self, env):
+        """Keep the subtree under env's position as the new root and prune everything else"""
+        tree = self.tree
+        root_key = self.counter_key(env)
+        root = tree.get(root_key)
+        if not tree.is_expanded(root):
+            tree.clear()
+            return
+
+        keys = [root_key]
+        seen = {root_key}
+        env = env.clone()
+        sl = tree.children(root)
+        stack = [iter(range(sl.start, sl.stop))]  # a level per pushed move below the root
+        while stack:
+            edge = next(stack[-1], None)
+            if edge is None:
+                stack.pop()
+                if stack:
+                    env.pop()
+                continue
+            if tree.n[edge] == 0:  # never descended, so nothing was expanded below it
+                continue
+            env.push(int(tree.action[edge]))
+            key = self.counter_key(env)
+            child = tree.get(key)
+            if key not in seen and tree.is_expanded(child):
+                seen.add(key)
+                keys.append(key)
+                sl = tree.children(child)
+                stack.append(iter(range(sl.start, sl.stop)))
+            else:
+                env.pop()
+        tree.retain(keys)
+
     def ask_thought_about(self, board) -> HistoryItem:
         return self.thinking_history.get(board)
 
-    def search_moves(self, board):
+    def search_moves(self, env):
         loop = self.loop
         self.running_simulation_num = 0
-
+        self.root_env = env
+        if not self.play_config.ismcts:
+            self.env_pool = [env.clone() for _ in range(self.play_config.parallel_search_num)]
+        self.root_p = None
+        self.search_done = False
+        loop.run_until_complete(self.run_simulations())
+
+    async def run_simulations(self):
+        worker = asyncio.ensure_future(self.prediction_worker())
         coroutine_list = []
         for it in range(self.play_config.simulation_num_per_move):
-            cor = self.start_search_my_move(board)
+            cor = self.start_search_my_move()
             coroutine_list.append(cor)
+        await asyncio.gather(*coroutine_list)
+        self.search_done = True
+        self.flush_event.set()
+        await worker
 
-        coroutine_list.append(self.prediction_worker())
-        loop.run_until_complete(asyncio.gather(*coroutine_list))
-
-    async def start_search_my_move(self, board):
+    async def start_search_my_move(self):
         self.running_simulation_num += 1
-        with await self.sem:  # reduce parallel search number
-            env = Connect4Env().update(board)
+        async with self.sem:  # reduce parallel search number
+            self.active_search_num += 1
+            if self.play_config.ismcts:
+                # every simulation plays out its own sample of the hidden cards
+                env = self.root_env.determinize(self.observer)
+            else:
+                env = self.env_pool.pop()  # a root position, restored by pop() on the way back
             leaf_v = await self.search_my_move(env, is_root_node=True)
+            if not self.play_config.ismcts:
+                self.env_pool.append(env)
+            self.active_search_num -= 1
             self.running_simulation_num -= 1
+            self.maybe_flush()
             return leaf_v
 
-    async def search_my_move(self, env: Connect4Env, is_root_node=False):
+    async def search_my_move(self, env: SequenceEnv, is_root_node=False):
         """
 
-        Q, V is value for this Player(always white).
-        P is value for the player of next_player (black or white)
+        Q, V is value for this Player(always blue).
+        P is value for the player of next_player (blue or red)
         :param env:
         :param is_root_node:
         :return:
         """
         if env.done:
-            if env.winner == Winner.white:
+            if env.winner == Winner.blue:
                 return 1
-            elif env.winner == Winner.black:
+            elif env.winner == Winner.red:
                 return -1
             else:
                 return 0
 
         key = self.counter_key(env)
+        tree = self.tree
 
-        while key in self.now_expanding:
-            await asyncio.sleep(self.config.play.wait_for_expanding_sleep_sec)
+        expanding = self.expanding.get(key)
+        if expanding is not None:  # another simulation is evaluating this leaf
+            self.blocked_search_num += 1
+            self.maybe_flush()
+            await expanding
+            self.blocked_search_num -= 1
 
         # is leaf?
-        if key not in self.expanded:  # reach leaf node
+        node = tree.get(key)
+        if not tree.is_expanded(node):  # reach leaf node
             leaf_v = await self.expand_and_evaluate(env)
-            if env.player_turn() == Player.white:
-                return leaf_v  # Value for white
+            if env.player_turn() == Player.blue:
+                return leaf_v  # Value for blue
             else:
-                return -leaf_v  # Value for white == -Value for white
+                return -leaf_v  # Value for blue == -Value for red
 
-        action_t = self.select_action_q_and_u(env, is_root_node)
-        _, _ = env.step(action_t)
+        edge = self.select_action_q_and_u(env, node, is_root_node)
+        if edge is None:  # no legal move: a draw, see SequenceEnv.mover_stuck()
+            return 0
+        env.push(int(tree.action[edge]))
 
         virtual_loss = self.config.play.virtual_loss
-        self.var_n[key][action_t] += virtual_loss
-        self.var_w[key][action_t] -= virtual_loss
+        tree.n[edge] += virtual_loss
+        tree.w[edge] -= virtual_loss
         leaf_v = await self.search_my_move(env)  # next move
+        if tree.child[edge] < 0:  # link the edge to the (possibly shared) child node
+            tree.child[edge] = tree.get(self.counter_key(env))
+        env.pop()
 
         # on returning search path
         # update: N, W, Q, U
-        n = self.var_n[key][action_t] = self.var_n[key][action_t] - virtual_loss + 1
-        w = self.var_w[key][action_t] = self.var_w[key][action_t] + virtual_loss + leaf_v
-        self.var_q[key][action_t] = w / n
+        n = tree.n[edge] = tree.n[edge] - virtual_loss + 1
+        w = tree.w[edge] = tree.w[edge] + virtual_loss + leaf_v
+        tree.q[edge] = w / n
+        tree.update_node_q(node)
         return leaf_v
 
     async def expand_and_evaluate(self, env):
         """expand new leaf
 
-        update var_p, return leaf_v
+        add the node with one edge per legal move and its P, return leaf_v
 
-        :param ChessEnv env:
+        :param SequenceEnv env:
         :return: leaf_v
         """
         key = self.counter_key(env)
-        self.now_expanding.add(key)
-
-        black_ary, white_ary = env.black_and_white_plane()
-        state = [black_ary, white_ary] if env.player_turn() == Player.black else [white_ary, black_ary]
-        future = await self.predict(np.array(state))  # type: Future
-        await future
-        leaf_p, leaf_v = future.result()
-
-        self.var_p[key] = leaf_p  # P is value for next_player (black or white)
-        self.expanded.add(key)
-        self.now_expanding.remove(key)
+        node = self.tree.add_node(key)  # -1 if the pool is full: evaluate only
+        if node >= 0:
+            self.expanding[key] = self.loop.create_future()
+
+        if self.hidden_turn(env):
+            # one edge per move any sampled hand allows; selection filters by the sample at hand
+            legal_actions = np.flatnonzero(env.possible_action_mask(self.observer))
+            cache = None  # the evaluation depends on the sampled hand, not only on the key
+        else:
+            legal_actions = np.flatnonzero(env.legal_action_mask())
+            cache = self.cache
+        digest = self.model_digest()
+        cache_key = observation_key(env) if cache is not None else None
+        cached = cache.get(cache_key, digest) if cache is not None else None
+        if cached is not None:
+            priors, leaf_v = cached
+        else:
+            future = self.predict(env)  # type: Future
+            await future
+            leaf_p, leaf_v = future.result()
+            priors = leaf_p[legal_actions]
+            if cache is not None:
+                cache.put(cache_key, digest, priors, leaf_v)
+
+        if node >= 0:
+            # P is value for next_player (blue or red)
+            value = leaf_v if env.player_turn() == Player.blue else -leaf_v
+            if not self.tree.expand(node, legal_actions, priors, value):
+                self.tree.remove_node(key)
+            self.expanding.pop(key).set_result(None)
         return float(leaf_v)
 
+    def model_digest(self):
+        """Digest of the weights behind predictions, None when unknown (e.g. a shared server)"""
+        if self.model is None:
+            return None
+        return self.model.digest
+
     async def prediction_worker(self):
         """For better performance, queueing prediction requests and predict together in this worker.
 
-        speed up about 45sec -> 15sec for example.
+        Sleeps until maybe_flush() or the deadline of the oldest request wakes it up.
         :return:
         """
-        q = self.prediction_queue
-        margin = 10  # avoid finishing before other searches starting.
-        while self.running_simulation_num > 0 or margin > 0:
-            if q.empty():
-                if margin > 0:
-                    margin -= 1
-                await asyncio.sleep(self.config.play.prediction_worker_sleep_sec)
+        while True:
+            await self.flush_event.wait()
+            self.flush_event.clear()
+            self.batch_stats.wakeups += 1
+            if self.flush_deadline is not None:
+                self.flush_deadline.cancel()
+                self.flush_deadline = None
+            if not self.pending_predictions:
+                if self.search_done:
+                    return
                 continue
-            item_list = [q.get_nowait() for _ in range(q.qsize())]  # type: list[QueueItem]
-            # logger.debug(f"predicting {len(item_list)} items")
-            data = np.array([x.state for x in item_list])
+            item_list, self.pending_predictions = self.pending_predictions, []
+            data = self.input_buffer[:len(item_list)]  # states were encoded in place by predict()
             policy_ary, value_ary = self.api.predict(data)
             for p, v, item in zip(policy_ary, value_ary, item_list):
                 item.future.set_result((p, v))
+            self.batch_stats.record(len(item_list), self.loop.time() - self.first_request_time)
 
-    async def predict(self, x):
+    def predict(self, env):
         future = self.loop.create_future()
-        item = QueueItem(x, future)
-        await self.prediction_queue.put(item)
+        if not self.pending_predictions:
+            self.first_request_time = self.loop.time()
+            self.flush_deadline = self.loop.call_later(
+                self.play_config.prediction_max_latency_sec, self.flush_event.set)
+        state = encode_observation(env, out=self.input_buffer[len(self.pending_predictions)])
+        self.pending_predictions.append(QueueItem(state, future))
+        self.maybe_flush()
         return future
 
+    def maybe_flush(self):
+        """Wake the prediction worker once no more requests can join the batch"""
+        pending = len(self.pending_predictions)
+        if pending == 0:
+            return
+        can_request = self.active_search_num - self.blocked_search_num
+        if pending >= min(self.play_config.prediction_batch_size, can_request):
+            self.flush_event.set()
+
     def finish_game(self, z):
         """
 
@@ -189,47 +353,64 @@ class Connect4Player:
         """
         for move in self.moves:  # add this game winner result to all past moves.
             move += [z]
+        logger.debug(f"prediction batches: {self.batch_stats}")
+        if self.cache is not None:
+            logger.debug(f"evaluation cache: {self.cache}")
 
-    def calc_policy(self, board):
+    def calc_policy(self, env):
         """calc π(a|s0)
         :return:
         """
         pc = self.play_config
-        env = Connect4Env().update(board)
-        key = self.counter_key(env)
+        node = self.tree.get(self.counter_key(env))
+        var_n = self.tree.dense(node, self.tree.n, self.labels_n)
         if env.turn < pc.change_tau_turn:
-            return self.var_n[key] / np.sum(self.var_n[key])  # tau = 1
+            return var_n / np.sum(var_n)  # tau = 1
         else:
-            action = np.argmax(self.var_n[key])  # tau = 0
+            action = np.argmax(var_n)  # tau = 0
             ret = np.zeros(self.labels_n)
             ret[action] = 1
             return ret
 
-    @staticmethod
-    def counter_key(env: Connect4Env):
-        return CounterKey(env.observation, env.turn)
+    def counter_key(self, env: SequenceEnv):
+        # the hand decides which moves are legal, so it is part of the node key
+        if self.play_config.ismcts:
+            # information set of this player: the opponent's hand is unknown
+            return env.zobrist_key() ^ env.state.hand_hash[self.observer]
+        return env.zobrist_key(include_hand=True)
 
-    def select_action_q_and_u(self, env, is_root_node):
-        key = self.counter_key(env)
+    def hidden_turn(self, env: SequenceEnv):
+        """True if ISMCTS is searching a move made from a hand this player cannot see"""
+        return self.play_config.ismcts and env.state.current_player != self.observer
 
-        legal_moves = env.legal_moves()
+    def select_action_q_and_u(self, env, node, is_root_node):
+        """Pick the edge of `node` to descend
 
-        # noinspection PyUnresolvedReferences
-        xx_ = np.sqrt(np.sum(self.var_n[key]))  # SQRT of sum(N(s, b); for all b)
-        xx_ = max(xx_, 1)  # avoid u_=0 if N is all 0
-        p_ = self.var_p[key]
+        Its edges are exactly the legal moves, except on hidden turns of
+        ISMCTS where only the edges the sampled hand can play are eligible.
+        """
+        tree = self.tree
+        sl = tree.children(node)
+        if sl.start == sl.stop:
+            return None
+        # When enemy's selecting action, flip Q-Value.
+        sign = 1 if env.player_turn() == Player.blue else -1
+
+        if self.hidden_turn(env):
+            available = np.flatnonzero(env.legal_action_mask()[tree.action[sl]])
+            if len(available) == 0:
+                return None
+            edges = sl.start + available
+            return int(edges[select_puct(tree.n[edges], tree.edge_q(edges), tree.p[edges],
+                                         self.play_config.c_puct, sign)])
+
+        p_ = tree.p[sl]
 
         if is_root_node:  # Is it correct?? -> (1-e)p + e*Dir(0.03)
-            p_ = (1 - self.play_config.noise_eps) * p_ + \
-                 self.play_config.noise_eps * np.random.dirichlet([self.play_config.dirichlet_alpha] * self.labels_n)
-
-        u_ = self.play_config.c_puct * p_ * xx_ / (1 + self.var_n[key])
-        if env.player_turn() == Player.white:
-            v_ = (self.var_q[key] + u_ + 1000) * legal_moves
-        else:
-            # When enemy's selecting action, flip Q-Value.
-            v_ = (-self.var_q[key] + u_ + 1000) * legal_moves
+            if self.root_p is None:
+                pc = self.play_config
+                self.root_p = (1 - pc.noise_eps) * p_ + \
+                    pc.noise_eps * np.random.dirichlet([pc.dirichlet_alpha] * len(p_))
+            p_ = self.root_p
 
-        # noinspection PyTypeChecker
-        action_t = int(np.argmax(v_))
-        return action_t
+        return sl.start + select_puct(tree.n[sl], tree.edge_q(sl), p_, self.play_config.c_puct, sign)
@@ -1,5 +1,7 @@
 import os
 
+from connect4_zero.env.sequence_env import N_ACTIONS
+
 def _project_dir():
     d = os.path.dirname
     return d(d(d(os.path.abspath(__file__))))
@@ -27,11 +29,13 @@ class Config:
         self.play_data = c.PlayDataConfig()
         self.trainer = c.TrainerConfig()
         self.eval = c.EvaluateConfig()
-        self.n_labels = 7
+        self.n_labels = N_ACTIONS
 
 
 class Options:
     new = False
+    workers = 1
+    lockstep_games = 0
 
 
 class ResourceConfig:
@@ -53,14 +57,16 @@ class ResourceConfig:
         self.next_generation_model_weight_filename = "model_weight.h5"
 
         self.play_data_dir = os.path.join(self.data_dir, "play_data")
-        self.play_data_filename_tmpl = "play_%s.json"
+        self.play_data_filename_tmpl = "play_%s.sqpd"  # see connect4_zero.lib.play_data
+        self.json_play_data_filename_tmpl = "play_%s.json"  # before the binary format
+        self.replay_buffer_dir = os.path.join(self.data_dir, "replay_buffer")
 
         self.log_dir = os.path.join(self.project_dir, "logs")
         self.main_log_path = os.path.join(self.log_dir, "main.log")
 
     def create_directories(self):
         dirs = [self.project_dir, self.data_dir, self.model_dir, self.play_data_dir, self.log_dir,
-                self.next_generation_model_dir]
+                self.next_generation_model_dir, self.replay_buffer_dir]
         for d in dirs:
             if not os.path.exists(d):
                 os.makedirs(d)
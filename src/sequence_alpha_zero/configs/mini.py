@@ -14,6 +14,7 @@ class PlayDataConfig:
     def __init__(self):
         self.nb_game_in_file = 50
         self.max_file_num = 50
+        self.compress = True  # zlib per chunk of play data
 
 
 class PlayConfig:
@@ -27,11 +28,18 @@ class PlayConfig:
         self.dirichlet_alpha = 0.03
         self.change_tau_turn = 10
         self.virtual_loss = 3 # loss for repeating the same action
-        self.prediction_queue_size = 16
+        self.prediction_batch_size = 16
         # self.parallel_search_num = 4
         self.parallel_search_num = 1
-        self.prediction_worker_sleep_sec = 0.00001
-        self.wait_for_expanding_sleep_sec = 0.000001
+        self.prediction_max_latency_sec = 0.001
+        self.inference_batch_size = 256
+        self.inference_max_latency_sec = 0.002
+        self.model_reload_interval_sec = 60
+        self.tree_node_capacity = 4096
+        self.tree_edge_capacity = 131072
+        self.reuse_tree = True
+        self.ismcts = False  # search information sets over sampled hidden cards
+        self.eval_cache_max_bytes = 64 * 1024 * 1024
 
 
 class TrainerConfig:
@@ -42,6 +50,13 @@ class TrainerConfig:
         self.start_total_steps = 0
         self.save_model_steps = 100
         self.load_data_steps = 100
+        self.replay_buffer_size = 100000  # records kept on disk, oldest evicted first
+        self.replay_policy_entries = 128  # most visited moves kept per policy
+        self.replay_dedup = True  # merge repeated positions, averaging their targets
+        self.prefetch_batches = 4
+        self.loader_thread_num = 2
+        self.convert_process_num = 4  # processes decoding new play data files
+        self.augment_symmetry = True  # random board symmetry per record, if the layout has any
 
 
 class ModelConfig:
@@ -0,0 +1,114 @@
+import random
+
+import numpy as np
+
+from connect4_zero.env.sequence_env import SequenceEnv, CardBelief, BOARD_SIZE, N_CARDS, CORNER_MASK, FULL_MASK, \
+    CARD_MASKS, TWO_EYED_JACKS, ONE_EYED_JACKS, bits_to_array
+
+# Network input from the point of view of the player to move, shared by the
+# search and training (self-play stores observation_record(), the optimizer
+# expands it with encode_record()). Planes:
+#   0: own chips, 1: opponent chips, 2: corners (free for both players),
+#   3: empty cells the player to move can place on from its hand (two-eyed jacks: all of them),
+#   4: opponent chips it can remove (all of them when it holds a one-eyed jack),
+#   5: chance the opponent holds a card placing on each cell (CardBelief.cell_plane)
+N_PLANES = 6
+PLANE_SHAPE = (BOARD_SIZE, BOARD_SIZE, N_PLANES)
+
+# play data keeps planes as int8: the 0/1 planes as is, the belief plane in 1/127 steps
+PLANE_SCALE = np.array([1, 1, 1, 1, 1, 127], dtype=np.float32)
+
+_CORNER_PLANE = bits_to_array(CORNER_MASK).reshape(BOARD_SIZE, BOARD_SIZE)
+
+# Zobrist keys of what the belief plane reads: the count (0-2) of each card
+# the mover has not seen, and the opponent's hand size
+_key_rng = random.Random(20241018)
+_UNSEEN_KEYS = np.array([[_key_rng.getrandbits(64) for _ in range(3)] for _ in range(N_CARDS)], dtype=np.uint64)
+_HAND_SIZE_KEYS = tuple(_key_rng.getrandbits(64) for _ in range(2 * N_CARDS + 1))
+
+
+def encode_observation(env: SequenceEnv, out=None):
+    """Write the planes of env's current position into `out`
+
+    :param out: a (BOARD_SIZE, BOARD_SIZE, N_PLANES) float32 slot, e.g. batch[i]; allocated if None
+    :return: out
+    """
+    me = env.state.current_player
+    opponent = env.agents[1 - me]
+    belief = env.state.beliefs[me]
+    place, remove = hand_cells(env.agents[me].hand, env.state.empty_cells(), env.state.chips[1 - me])
+    return _write_planes(out, env.state.chips[me], env.state.chips[1 - me], place, remove,
+                         belief.cell_plane(len(opponent.hand)))
+
+
+def observation_key(env: SequenceEnv):
+    """64-bit key of encode_observation(env) and of the legal moves
+
+    The chips, side to move and mover's hand (env.zobrist_key(include_hand=True))
+    fix every plane but the belief one, and the legal moves; the belief plane
+    depends only on the mover's unseen card counts and the opponent's hand size,
+    which the discards change without showing on the board.
+    """
+    me = env.state.current_player
+    unseen = env.state.beliefs[me].unseen
+    belief_key = int(np.bitwise_xor.reduce(_UNSEEN_KEYS[np.arange(N_CARDS), unseen]))
+    return env.zobrist_key(include_hand=True) ^ belief_key ^ _HAND_SIZE_KEYS[len(env.agents[1 - me].hand)]
+
+
+def observation_record(env: SequenceEnv):
+    """JSON-able compact form of encode_observation's input, kept in play data
+
+    [own chips, opponent chips, placeable cells, removable cells (bitboards as ints),
+    unseen card counts, opponent hand size]
+    """
+    me = env.state.current_player
+    place, remove = hand_cells(env.agents[me].hand, env.state.empty_cells(), env.state.chips[1 - me])
+    return [env.state.chips[me], env.state.chips[1 - me], place, remove,
+            env.state.beliefs[me].unseen.tolist(), len(env.agents[1 - me].hand)]
+
+
+def encode_record(record, out=None):
+    """encode_observation() for a record made by observation_record()"""
+    own, opponent, place, remove, unseen, opponent_hand_size = record
+    belief = CardBelief.from_unseen(np.asarray(unseen, dtype=np.int8).reshape(N_CARDS))
+    return _write_planes(out, own, opponent, place, remove, belief.cell_plane(opponent_hand_size))
+
+
+def quantize_planes(planes):
+    """int8 copy of planes (any leading batch shape) for storage"""
+    return np.rint(planes * PLANE_SCALE).astype(np.int8)
+
+
+def dequantize_planes(planes, out=None):
+    """Inverse of quantize_planes(), as float32"""
+    return np.divide(planes, PLANE_SCALE, out=out, dtype=np.float32)
+
+
+def hand_cells(hand, empty, opponent_chips):
+    """Bitboards of the cells `hand` can place a chip on and remove one from, as in legal_action_mask()
+
+    :param empty: bitboard of empty cells (SequenceState.empty_cells())
+    :param opponent_chips: bitboard of the opponent's chips
+    :return: (place, remove)
+    """
+    place = remove = 0
+    for card in hand:
+        if card in TWO_EYED_JACKS:
+            place = FULL_MASK & ~CORNER_MASK
+        elif card in ONE_EYED_JACKS:
+            remove = opponent_chips
+        else:
+            place |= CARD_MASKS[card]
+    return place & empty, remove
+
+
+def _write_planes(out, own, opponent, place, remove, belief_plane):
+    if out is None:
+        out = np.empty(PLANE_SHAPE, dtype=np.float32)
+    out[:, :, 0] = bits_to_array(own).reshape(BOARD_SIZE, BOARD_SIZE)
+    out[:, :, 1] = bits_to_array(opponent).reshape(BOARD_SIZE, BOARD_SIZE)
+    out[:, :, 2] = _CORNER_PLANE
+    out[:, :, 3] = bits_to_array(place).reshape(BOARD_SIZE, BOARD_SIZE)
+    out[:, :, 4] = bits_to_array(remove).reshape(BOARD_SIZE, BOARD_SIZE)
+    out[:, :, 5] = belief_plane.reshape(BOARD_SIZE, BOARD_SIZE)
+    return out
@@ -1,7 +1,9 @@
 import enum
 import random
+from collections import namedtuple
+from types import MappingProxyType
+
 import numpy as np
-from collections import defaultdict
 
 # Constants
 RED = "r"
@@ -13,11 +15,172 @@ EMPTY = "_"
 Winner = enum.Enum("Winner", "red blue draw")
 Player = enum.Enum("Player", "red blue")
 
-# Card to board coordinates mapping (must be defined)
-COORDS = defaultdict(list)
-# Populate this with actual card positions from Sequence board
-# Example: COORDS['as'] = [(0,0), (2,2)] etc.
+# everything step() changes that can't be recomputed from the action
+UndoItem = namedtuple(
+    "UndoItem",
+    "action hand_pos drawn card_flag drawn_flag done winner completed_seqs",
+)
+
+RANKS = ["2", "3", "4", "5", "6", "7", "8", "9", "t", "j", "q", "k", "a"]
+SUITS = ["d", "c", "h", "s"]
+RANK_MAP = {rank: i for i, rank in enumerate(RANKS)}
+SUIT_MAP = {suit: i for i, suit in enumerate(SUITS)}
+
+BOARD_LAYOUT = (
+    ("jk", "2s", "3s", "4s", "5s", "6s", "7s", "8s", "9s", "jk"),
+    ("6c", "5c", "4c", "3c", "2c", "ah", "kh", "qh", "th", "ts"),
+    ("7c", "as", "2d", "3d", "4d", "5d", "6d", "7d", "9h", "qs"),
+    ("8c", "ks", "6c", "5c", "4c", "3c", "2c", "8d", "8h", "ks"),
+    ("9c", "qs", "7c", "6h", "5h", "4h", "ah", "9d", "7h", "as"),
+    ("tc", "ts", "8c", "7h", "2h", "3h", "kh", "td", "6h", "2d"),
+    ("qc", "9s", "9c", "8h", "9h", "th", "qh", "qd", "5h", "3d"),
+    ("kc", "8s", "tc", "qc", "kc", "ac", "ad", "kd", "4h", "4d"),
+    ("ac", "7s", "6s", "5s", "4s", "3s", "2s", "2h", "3h", "5d"),
+    ("jk", "ad", "kd", "qd", "td", "9d", "8d", "7d", "6d", "jk"),
+)
+
+
+def card_to_index(card):
+    """Convert card string to index in one-hot vector"""
+    if len(card) != 2:
+        return -1  # Invalid card
+
+    rank, suit = card[0], card[1]
+    return RANK_MAP[rank] * 4 + SUIT_MAP[suit]
+
+
+# Bitboard layout: cell (r, c) is bit r * 10 + c of a 100-bit int
+BOARD_SIZE = 10
+N_CELLS = BOARD_SIZE * BOARD_SIZE
+FULL_MASK = (1 << N_CELLS) - 1
+CORNERS = [(0, 0), (0, 9), (9, 0), (9, 9)]
+
+
+def cell_bit(r, c):
+    return 1 << (r * BOARD_SIZE + c)
+
+
+def iter_bits(bb):
+    """Yield (r, c) for every set bit of a bitboard"""
+    while bb:
+        low = bb & -bb
+        idx = low.bit_length() - 1
+        yield divmod(idx, BOARD_SIZE)
+        bb ^= low
+
+
+def popcount(bb):
+    return bin(bb).count("1")
+
+
+CORNER_MASK = 0
+for _r, _c in CORNERS:
+    CORNER_MASK |= cell_bit(_r, _c)
+
+
+def _build_lines():
+    """All 192 five-cell lines as tuples of flat cell indices"""
+    lines = []
+    for dr, dc in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        for r in range(BOARD_SIZE):
+            for c in range(BOARD_SIZE):
+                cells = [(r + dr * i, c + dc * i) for i in range(5)]
+                if all(0 <= rr < BOARD_SIZE and 0 <= cc < BOARD_SIZE for rr, cc in cells):
+                    lines.append(tuple(rr * BOARD_SIZE + cc for rr, cc in cells))
+    return tuple(lines)
+
+
+LINES = _build_lines()
+LINE_MASKS = tuple(sum(1 << idx for idx in line) for line in LINES)
+# cell index -> ids of the lines passing through it
+CELL_LINES = tuple(
+    tuple(l for l, line in enumerate(LINES) if idx in line) for idx in range(N_CELLS)
+)
+# cells owned on each line before any chip is placed (the corners)
+_INITIAL_LINE_COUNTS = [popcount(mask & CORNER_MASK) for mask in LINE_MASKS]
+
+
+def _build_coords():
+    """Card string and card index -> flat cell indices showing that card"""
+    coords = {r + s: [] for r in RANKS for s in SUITS}
+    for r, row in enumerate(BOARD_LAYOUT):
+        for c, card in enumerate(row):
+            if card in coords:
+                coords[card].append(r * BOARD_SIZE + c)
+    index = {}
+    for card, cells in coords.items():
+        index[card] = index[card_to_index(card)] = tuple(cells)
+    return MappingProxyType(index)
+
+
+# Jacks have no printed cells, so they map to an empty tuple
+COORDS = _build_coords()
+CARD_MASKS = MappingProxyType(
+    {card: sum(1 << idx for idx in cells) for card, cells in COORDS.items()}
+)
+
+TWO_EYED_JACKS = ["jd", "jc"]
+ONE_EYED_JACKS = ["jh", "js"]
+
+# Fixed action space: action = (type * N_CARDS + card_index) * N_CELLS + cell
+N_CARDS = len(RANKS) * len(SUITS)
+ACTION_TYPES = ["place", "remove"]
+N_ACTIONS = len(ACTION_TYPES) * N_CARDS * N_CELLS
+
+
+def _build_place_targets():
+    """(N_CARDS, N_CELLS) bool: cells each card may place a chip on when empty"""
+    targets = np.zeros((N_CARDS, N_CELLS), dtype=bool)
+    for card, cells in COORDS.items():
+        if isinstance(card, str):
+            targets[card_to_index(card), list(cells)] = True
+    for card in TWO_EYED_JACKS:
+        targets[card_to_index(card)] = True
+    for r, c in CORNERS:
+        targets[:, r * BOARD_SIZE + c] = False
+    return targets
+
+
+PLACE_TARGETS = _build_place_targets()
+REMOVE_CARDS = np.zeros(N_CARDS, dtype=bool)
+REMOVE_CARDS[[card_to_index(card) for card in ONE_EYED_JACKS]] = True
+
 
+CARD_NAMES = tuple(rank + suit for rank in RANKS for suit in SUITS)  # by card_to_index
+
+
+def encode_action(action):
+    """Action dict -> index in the fixed action space"""
+    r, c = action["coords"]
+    action_type = ACTION_TYPES.index(action["type"])
+    return (action_type * N_CARDS + card_to_index(action["card"])) * N_CELLS + r * BOARD_SIZE + c
+
+
+def decode_action(action_id):
+    """Index in the fixed action space -> action dict"""
+    rest, cell = divmod(int(action_id), N_CELLS)
+    action_type, card_index = divmod(rest, N_CARDS)
+    card = CARD_NAMES[card_index]
+    return {"type": ACTION_TYPES[action_type], "card": card, "coords": divmod(cell, BOARD_SIZE)}
+
+
+def bits_to_array(bb):
+    """Bitboard -> (N_CELLS,) bool array indexed by flat cell"""
+    raw = np.frombuffer(bb.to_bytes((N_CELLS + 7) // 8, "little"), dtype=np.uint8)
+    return np.unpackbits(raw).reshape(-1, 8)[:, ::-1].ravel()[:N_CELLS].astype(bool)
+
+
+# Zobrist keys: chip of agent id on cell, side to move, and the k-th copy of
+# a card in an agent's hand (the double deck allows two copies)
+_zobrist_rng = random.Random(20241017)
+ZOBRIST_CHIPS = tuple(
+    tuple(_zobrist_rng.getrandbits(64) for _ in range(N_CELLS)) for _ in range(2)
+)
+ZOBRIST_SIDE = _zobrist_rng.getrandbits(64)
+ZOBRIST_HAND = tuple(
+    tuple(tuple(_zobrist_rng.getrandbits(64) for _ in range(2)) for _ in range(N_CARDS))
+    for _ in range(2)
+)
 
 class AgentState:
     def __init__(self, _id):
@@ -27,47 +190,161 @@ class AgentState:
         self.completed_seqs = 0
         self.score = 0
 
+    def copy(self):
+        agent = AgentState.__new__(AgentState)
+        agent.__dict__.update(self.__dict__)
+        agent.hand = self.hand[:]
+        return agent
+
+
+class CardBelief:
+    """What one agent knows about the cards it cannot see
+
+    `unseen` counts the copies of each card (two per card in the double
+    deck) that are neither in the agent's hand nor played; every played
+    card goes to the discard pile, chips on the board included. Those
+    copies are spread uniformly over the opponent's hand and the deck, so
+    the counts are the whole posterior: every event is an O(1) update, and
+    the network plane and the determinization sampler both read them.
+    """
+
+    def __init__(self):
+        self.unseen = np.full(N_CARDS, 2, dtype=np.int8)
+        self.total = 2 * N_CARDS
+
+    @classmethod
+    def from_unseen(cls, unseen):
+        """Belief with the given (N_CARDS,) unseen counts"""
+        belief = cls.__new__(cls)
+        belief.unseen = unseen.astype(np.int8)
+        belief.total = int(np.sum(unseen))
+        return belief
+
+    def copy(self):
+        belief = CardBelief.__new__(CardBelief)
+        belief.unseen = self.unseen.copy()
+        belief.total = self.total
+        return belief
+
+    def see(self, card_index):
+        """A copy of the card was drawn by this agent or played by the opponent"""
+        self.unseen[card_index] -= 1
+        self.total -= 1
+
+    def unsee(self, card_index):
+        """Undo see()"""
+        self.unseen[card_index] += 1
+        self.total += 1
+
+    def probabilities(self):
+        """(N_CARDS,) chance that a given unseen card is of each kind"""
+        if self.total == 0:
+            return np.zeros(N_CARDS)
+        return self.unseen / self.total
+
+    def hold_probabilities(self, hand_size):
+        """(N_CARDS,) chance that an opponent hand of `hand_size` unseen cards has at least one copy"""
+        u = self.total
+        if u == 0 or hand_size == 0:
+            return np.zeros(N_CARDS)
+        none_of_one = max(u - hand_size, 0) / u  # hypergeometric: no copy among hand_size draws
+        none_of_two = none_of_one * max(u - 1 - hand_size, 0) / (u - 1) if u > 1 else 0
+        return 1 - np.choose(self.unseen, [1, none_of_one, none_of_two])
+
+    def cell_plane(self, hand_size):
+        """(N_CELLS,) float32 chance the opponent holds a card placing on each cell, jacks included"""
+        held = self.hold_probabilities(hand_size)
+        miss = np.where(PLACE_TARGETS, 1 - held[:, None], 1)
+        return (1 - np.prod(miss, axis=0)).astype(np.float32)
+
+    def sample(self, n=None, rng=np.random):
+        """Card indices of `n` unseen copies drawn without replacement; all of them shuffled if n is None"""
+        cards = np.repeat(np.arange(N_CARDS), self.unseen)
+        if n is None:
+            return rng.permutation(cards)
+        return rng.choice(cards, n, replace=False)
+
 
 class SequenceState:
     def __init__(self):
         # self.board = np.zeros((10, 10))  # 10x10 board
-        self.board = [
-            ["jk", "2s", "3s", "4s", "5s", "6s", "7s", "8s", "9s", "jk"],
-            ["6c", "5c", "4c", "3c", "2c", "ah", "kh", "qh", "th", "ts"],
-            ["7c", "as", "2d", "3d", "4d", "5d", "6d", "7d", "9h", "qs"],
-            ["8c", "ks", "6c", "5c", "4c", "3c", "2c", "8d", "8h", "ks"],
-            ["9c", "qs", "7c", "6h", "5h", "4h", "ah", "9d", "7h", "as"],
-            ["tc", "ts", "8c", "7h", "2h", "3h", "kh", "td", "6h", "2d"],
-            ["qc", "9s", "9c", "8h", "9h", "th", "qh", "qd", "5h", "3d"],
-            ["kc", "8s", "tc", "qc", "kc", "ac", "ad", "kd", "4h", "4d"],
-            ["ac", "7s", "6s", "5s", "4s", "3s", "2s", "2h", "3h", "5d"],
-            ["jk", "ad", "kd", "qd", "td", "9d", "8d", "7d", "6d", "jk"],
-        ]
+        self.board = BOARD_LAYOUT
         self.hand = np.zeros(104)  # One-hot vector for player's hand
-        self.opponent_belief = np.full(104, 1 / 104)  # Uniform prior
-        self.chips = np.zeros((10, 10))  # -1: red, 0: empty, 1: blue
+        self.beliefs = [CardBelief(), CardBelief()]  # per agent id: cards it has not seen
+        self.chips = [0, 0]  # one bitboard per agent id (0: blue, 1: red)
+        # per agent: owned cells on each line in LINES, and completed lines
+        self.line_counts = [list(_INITIAL_LINE_COUNTS), list(_INITIAL_LINE_COUNTS)]
+        self.sequences = [0, 0]
         self.discard_pile = []
         self.current_player = 0
         self.turn = 0
+        # incremental Zobrist hashes of chips + side to move, and of each hand
+        self.zobrist = 0
+        self.hand_hash = [0, 0]
+
+    def copy(self):
+        state = SequenceState.__new__(SequenceState)
+        state.board = self.board
+        state.hand = self.hand.copy()
+        state.beliefs = [self.beliefs[0].copy(), self.beliefs[1].copy()]
+        state.chips = self.chips[:]
+        state.line_counts = [self.line_counts[0][:], self.line_counts[1][:]]
+        state.sequences = self.sequences[:]
+        state.discard_pile = self.discard_pile[:]
+        state.current_player = self.current_player
+        state.turn = self.turn
+        state.zobrist = self.zobrist
+        state.hand_hash = self.hand_hash[:]
+        return state
 
     def get_observation(self):
         """Returns observation for RL agent"""
         return {
             "board": self.board,
-            "chips": self.chips,
+            "chips": self.chip_plane(),
             "hand": self.hand,
-            "opponent_belief": self.opponent_belief,
+            "opponent_belief": self.beliefs[self.current_player].probabilities(),
             "current_player": self.current_player,
         }
 
-    def update_belief(self, card_played):
-        """Bayesian update of opponent card beliefs"""
-        if card_played in self.discard_pile:
-            self.opponent_belief[card_played] = 0
-        # Normalize probabilities
-        total = np.sum(self.opponent_belief)
-        if total > 0:
-            self.opponent_belief /= total
+    def chip_plane(self):
+        """Chips as a 10x10 array: -1: red, 0: empty, 1: blue"""
+        plane = np.zeros((BOARD_SIZE, BOARD_SIZE))
+        for r, c in iter_bits(self.chips[0]):
+            plane[r][c] = 1
+        for r, c in iter_bits(self.chips[1]):
+            plane[r][c] = -1
+        return plane
+
+    def place_chip(self, player_id, r, c):
+        idx = r * BOARD_SIZE + c
+        self.chips[player_id] |= 1 << idx
+        self.zobrist ^= ZOBRIST_CHIPS[player_id][idx]
+        counts = self.line_counts[player_id]
+        for l in CELL_LINES[idx]:
+            counts[l] += 1
+            if counts[l] == 5:
+                self.sequences[player_id] += 1
+
+    def remove_chip(self, player_id, r, c):
+        idx = r * BOARD_SIZE + c
+        self.chips[player_id] &= ~(1 << idx)
+        self.zobrist ^= ZOBRIST_CHIPS[player_id][idx]
+        counts = self.line_counts[player_id]
+        for l in CELL_LINES[idx]:
+            if counts[l] == 5:
+                self.sequences[player_id] -= 1
+            counts[l] -= 1
+
+    def toggle_hand_card(self, player_id, card, copy_index):
+        self.hand_hash[player_id] ^= ZOBRIST_HAND[player_id][card_to_index(card)][copy_index]
+
+    def empty_cells(self):
+        return FULL_MASK & ~(self.chips[0] | self.chips[1] | CORNER_MASK)
+
+    def update_belief(self, player_id, card_played):
+        """The opponent of `player_id` sees the card it played"""
+        self.beliefs[1 - player_id].see(card_to_index(card_played))
 
 
 class Deck:
@@ -76,14 +353,17 @@ class Deck:
         self.reset()
 
     def reset(self):
-        ranks = ["2", "3", "4", "5", "6", "7", "8", "9", "t", "j", "q", "k", "a"]
-        suits = ["d", "c", "h", "s"]
-        self.cards = [r + s for r in ranks for s in suits] * 2
+        self.cards = [r + s for r in RANKS for s in SUITS] * 2
         random.shuffle(self.cards)
 
     def deal(self, n=7):
         return [self.cards.pop() for _ in range(n)] if n <= len(self.cards) else []
 
+    def copy(self):
+        deck = Deck.__new__(Deck)
+        deck.cards = self.cards[:]
+        return deck
+
 
 class SequenceEnv:
     def __init__(self):
@@ -100,22 +380,118 @@ class SequenceEnv:
         for agent in self.agents:
             agent.hand = self.deck.deal(7)
             # Update one-hot hand representation
-            for card in agent.hand:
+            for i, card in enumerate(agent.hand):
                 self.state.hand[card_to_index(card)] = 1
-
-        # Initialize board positions
-        self.state.chips = np.zeros((10, 10))
-        for r, c in [(0, 0), (0, 9), (9, 0), (9, 9)]:
-            self.state.chips[r][c] = JOKER
+                self.state.toggle_hand_card(agent.id, card, agent.hand[:i].count(card))
+                self.state.beliefs[agent.id].see(card_to_index(card))
 
         self.done = False
         self.winner = None
+        self.history = []  # UndoItem per push()
         return self.state.get_observation()
 
+    def clone(self):
+        """Independent copy of the current position (without undo history)"""
+        env = SequenceEnv.__new__(SequenceEnv)
+        env.state = self.state.copy()
+        env.deck = self.deck.copy()
+        env.agents = [agent.copy() for agent in self.agents]
+        env.done = self.done
+        env.winner = self.winner
+        env.history = []
+        return env
+
+    def player_turn(self):
+        return Player.blue if self.state.current_player == 0 else Player.red
+
+    def zobrist_key(self, include_hand=False):
+        """64-bit hash of chips and side to move, optionally with the mover's hand"""
+        key = self.state.zobrist
+        if include_hand:
+            key ^= self.state.hand_hash[self.state.current_player]
+        return key
+
+    @property
+    def turn(self):
+        return self.state.turn
+
+    @property
+    def observation(self):
+        """Hashable chip position (blue bitboard, red bitboard)"""
+        return tuple(self.state.chips)
+
     def step(self, action):
-        """Execute one game turn"""
+        """Execute one game turn
+
+        :param dict|int action: action dict or index from encode_action
+        """
         if self.done:
             return self.state.get_observation(), 0, True, {}
+        reward = self._play(action)
+        return self.state.get_observation(), reward, self.done, {}
+
+    def push(self, action):
+        """Play `action` like step(), remembering how to take it back with pop()"""
+        if not isinstance(action, dict):
+            action = decode_action(action)
+        if self.done:
+            self.history.append(None)
+            return
+        player = self.agents[self.state.current_player]
+        card = action["card"]
+        drawn = self.deck.cards[-1] if self.deck.cards else None
+        self.history.append(
+            UndoItem(
+                action,
+                player.hand.index(card),
+                drawn,
+                self.state.hand[card_to_index(card)],
+                self.state.hand[card_to_index(drawn)] if drawn else None,
+                self.done,
+                self.winner,
+                [agent.completed_seqs for agent in self.agents],
+            )
+        )
+        self._play(action)
+
+    def pop(self):
+        """Undo the last push()"""
+        undo = self.history.pop()
+        if undo is None:
+            return
+        state = self.state
+        state.turn -= 1
+        state.current_player = 1 - state.current_player
+        state.zobrist ^= ZOBRIST_SIDE
+        player = self.agents[state.current_player]
+
+        self.done = undo.done
+        self.winner = undo.winner
+        for agent, completed_seqs in zip(self.agents, undo.completed_seqs):
+            agent.completed_seqs = completed_seqs
+        state.discard_pile.pop()
+
+        card = undo.action["card"]
+        if undo.drawn is not None:
+            player.hand.pop()
+            state.toggle_hand_card(player.id, undo.drawn, player.hand.count(undo.drawn))
+            self.deck.cards.append(undo.drawn)
+            state.beliefs[player.id].unsee(card_to_index(undo.drawn))
+            state.hand[card_to_index(undo.drawn)] = undo.drawn_flag
+        state.toggle_hand_card(player.id, card, player.hand.count(card))
+        state.beliefs[1 - player.id].unsee(card_to_index(card))
+        player.hand.insert(undo.hand_pos, card)
+        state.hand[card_to_index(card)] = undo.card_flag
+
+        r, c = undo.action["coords"]
+        if undo.action["type"] == "place":
+            state.remove_chip(player.id, r, c)
+        else:
+            state.place_chip(1 - player.id, r, c)
+
+    def _play(self, action):
+        if not isinstance(action, dict):
+            action = decode_action(action)
 
         player = self.agents[self.state.current_player]
         reward = 0
@@ -123,22 +499,23 @@ class SequenceEnv:
         # Execute action
         if action["type"] == "place":
             r, c = action["coords"]
-            self.state.chips[r][c] = 1 if player.color == BLU else -1
+            self.state.place_chip(player.id, r, c)
             self.remove_card(player, action["card"])
 
         elif action["type"] == "remove":
             r, c = action["coords"]
-            self.state.chips[r][c] = EMPTY
+            self.state.remove_chip(1 - player.id, r, c)
             self.remove_card(player, action["card"])
 
         # Update game state
         self.state.discard_pile.append(action["card"])
-        self.state.update_belief(action["card"])
+        self.state.update_belief(player.id, action["card"])
         self.check_win_conditions()
 
         # Switch player
         self.state.current_player = 1 - self.state.current_player
         self.state.turn += 1
+        self.state.zobrist ^= ZOBRIST_SIDE
 
         # Calculate reward
         if self.done:
@@ -152,14 +529,17 @@ class SequenceEnv:
             # Intermediate reward for sequences
             reward = player.completed_seqs * 0.1
 
-        return self.state.get_observation(), reward, self.done, {}
+        return reward
 
     def remove_card(self, player, card):
         """Remove card from player's hand and draw new one"""
         player.hand.remove(card)
+        self.state.toggle_hand_card(player.id, card, player.hand.count(card))
         self.state.hand[card_to_index(card)] = 0
         if self.deck.cards:
             new_card = self.deck.deal(1)[0]
+            self.state.toggle_hand_card(player.id, new_card, player.hand.count(new_card))
+            self.state.beliefs[player.id].see(card_to_index(new_card))
             player.hand.append(new_card)
             self.state.hand[card_to_index(new_card)] = 1
 
@@ -179,106 +559,102 @@ class SequenceEnv:
             self.winner = Winner.draw
 
     def count_sequences(self, color):
-        count = 0
-        # Check all possible 5-in-a-row sequences
-
-        # Check rows
-        for r in range(10):
-            for c in range(6):
-                if all(self.state.chips[r][c + i] == color for i in range(5)):
-                    count += 1
-                elif all(
-                    self.state.chips[r][c + i] == JOKER
-                    or self.state.chips[r][c + i] == color
-                    for i in range(5)
-                ):
-                    count += 1
-
-        # Check columns
-        for r in range(6):
-            for c in range(10):
-                if all(self.state.chips[r][c + i] == color for i in range(5)):
-                    count += 1
-                elif all(
-                    self.state.chips[r + i][c] == JOKER
-                    or self.state.chips[r + i][c] == color
-                    for i in range(5)
-                ):
-                    count += 1
-
-        # Check diagonals
-        for r in range(6):
-            for c in range(6):
-                if all(self.state.chips[r + i][c + i] == color for i in range(5)):
-                    count += 1
-                elif all(
-                    self.state.chips[r + i][c + i] == JOKER
-                    or self.state.chips[r + i][c + i] == color
-                    for i in range(5)
-                ):
-                    count += 1
-                if all(self.state.chips[r + 4 - i][c + i] == color for i in range(5)):
-                    count += 1
-                elif all(
-                    self.state.chips[r + 4 - i][c + i] == JOKER
-                    or self.state.chips[r + 4 - i][c + i] == color
-                    for i in range(5)
-                ):
-                    count += 1
-
-        return count
+        """Number of completed 5-in-a-row lines of `color` (corners count for both)
+
+        The per-line counts are kept up to date by place_chip/remove_chip, so
+        this is a lookup rather than a board scan.
+        """
+        return self.state.sequences[0 if color == BLU else 1]
 
     def legal_actions(self):
         """Generate all legal moves for current player"""
         actions = []
         player = self.agents[self.state.current_player]
 
+        empty = self.state.empty_cells()
+
         for card in player.hand:
-            if card in ["jd", "jc"]:  # Two-eyed jacks (wild)
-                for r in range(10):
-                    for c in range(10):
-                        if self.state.chips[r][c] == EMPTY:
-                            actions.append(
-                                {"type": "place", "card": card, "coords": (r, c)}
-                            )
-            elif card in ["jh", "js"]:  # One-eyed jacks (remove)
-                opponent = BLU if player.color == RED else RED
-                for r in range(10):
-                    for c in range(10):
-                        if self.state.chips[r][c] == opponent:
-                            actions.append(
-                                {"type": "remove", "card": card, "coords": (r, c)}
-                            )
+            if card in TWO_EYED_JACKS:  # Two-eyed jacks (wild)
+                for r, c in iter_bits(empty):
+                    actions.append({"type": "place", "card": card, "coords": (r, c)})
+            elif card in ONE_EYED_JACKS:  # One-eyed jacks (remove)
+                opponent = self.state.chips[1 - player.id]
+                for r, c in iter_bits(opponent):
+                    actions.append({"type": "remove", "card": card, "coords": (r, c)})
             else:  # Regular cards
-                for r, c in COORDS[card]:
-                    if self.state.chips[r][c] == EMPTY:
-                        actions.append(
-                            {"type": "place", "card": card, "coords": (r, c)}
-                        )
+                for r, c in iter_bits(CARD_MASKS[card] & empty):
+                    actions.append({"type": "place", "card": card, "coords": (r, c)})
         return actions
 
+    def legal_action_mask(self):
+        """Legal moves for current player as a (N_ACTIONS,) bool array
 
-def card_to_index(card):
-    """Convert card string to index in one-hot vector"""
-    rank_map = {
-        "2": 0,
-        "3": 1,
-        "4": 2,
-        "5": 3,
-        "6": 4,
-        "7": 5,
-        "8": 6,
-        "9": 7,
-        "t": 8,
-        "j": 9,
-        "q": 10,
-        "k": 11,
-        "a": 12,
-    }
-    suit_map = {"d": 0, "c": 1, "h": 2, "s": 3}
-
-    if len(card) != 2:
-        return -1  # Invalid card
-
-    rank, suit = card[0], card[1]
-    return rank_map[rank] * 4 + suit_map[suit]
+        Same moves as legal_actions(), indexed by encode_action().
+        """
+        player = self.agents[self.state.current_player]
+        in_hand = np.zeros(N_CARDS, dtype=bool)
+        in_hand[[card_to_index(card) for card in player.hand]] = True
+        return self._action_mask(player.id, in_hand)
+
+    def mover_stuck(self):
+        """True if the player to move has no legal move
+
+        The rules have no case for this; self-play, evaluation and the search
+        all end the game there as a draw, without asking whether the
+        opponent could still move or win.
+        """
+        return not self.legal_action_mask().any()
+
+    def possible_action_mask(self, observer):
+        """Moves the current player might have, as far as agent `observer` can tell
+
+        For the observer's own turn this is legal_action_mask(); otherwise
+        every card the observer has not seen may be in the mover's hand.
+        """
+        if self.state.current_player == observer:
+            return self.legal_action_mask()
+        return self._action_mask(self.state.current_player, self.unseen_cards(observer) > 0)
+
+    def _action_mask(self, player_id, in_hand):
+        empty = bits_to_array(self.state.empty_cells())
+        opponent = bits_to_array(self.state.chips[1 - player_id])
+        place = in_hand[:, None] & PLACE_TARGETS & empty[None, :]
+        remove = (in_hand & REMOVE_CARDS)[:, None] & opponent[None, :]
+        return np.concatenate([place, remove]).ravel()
+
+    def unseen_cards(self, observer):
+        """(N_CARDS,) copies of each card `observer` has not seen: the opponent's hand and the deck
+
+        The belief's own array; do not modify it.
+        """
+        return self.state.beliefs[observer].unseen
+
+    def determinize(self, observer, rng=np.random):
+        """Clone with the opponent's hand and the deck order resampled from what `observer` has not seen
+
+        The hand size, deck size and everything visible to the observer
+        are kept, so the clone is one possible world of the observer's
+        information set.
+        """
+        env = self.clone()
+        opponent = env.agents[1 - observer]
+        unseen = [CARD_NAMES[i] for i in env.state.beliefs[observer].sample(rng=rng)]
+
+        state = env.state
+        for card in opponent.hand:
+            state.hand[card_to_index(card)] = 0
+        state.hand_hash[opponent.id] = 0
+        opponent.hand = unseen[:len(opponent.hand)]
+        env.deck.cards = unseen[len(opponent.hand):]
+        for i, card in enumerate(opponent.hand):
+            state.hand[card_to_index(card)] = 1
+            state.toggle_hand_card(opponent.id, card, opponent.hand[:i].count(card))
+        for card in env.agents[observer].hand:  # may share a card with the old opponent hand
+            state.hand[card_to_index(card)] = 1
+        # the opponent's belief must follow its sampled hand: it has not seen the
+        # observer's hand and the deck, and has seen what it now holds
+        unseen_opponent = state.beliefs[observer].unseen.astype(np.int16)
+        np.subtract.at(unseen_opponent, [card_to_index(card) for card in opponent.hand], 1)
+        np.add.at(unseen_opponent, [card_to_index(card) for card in env.agents[observer].hand], 1)
+        state.beliefs[opponent.id] = CardBelief.from_unseen(unseen_opponent)
+        return env
@@ -0,0 +1,100 @@
+from collections import namedtuple
+
+import numpy as np
+
+from connect4_zero.env.sequence_env import BOARD_LAYOUT, BOARD_SIZE, N_CELLS, N_CARDS, N_ACTIONS, ACTION_TYPES, \
+    CARD_NAMES
+
+# A board symmetry is one of the 8 transforms of the square grid, which map
+# five-cell lines onto lines and corners onto corners, together with a
+# relabeling of the cards so that every card's printed cells land on the
+# printed cells of its new label. Jacks are printed nowhere and keep their
+# label. Sources are gather tables: transformed[..., i] = original[..., source[i]]
+Symmetry = namedtuple("Symmetry", "name card_map cell_source action_source")
+
+GRID_TRANSFORMS = (
+    ("identity", lambda r, c: (r, c)),
+    ("rot90", lambda r, c: (c, BOARD_SIZE - 1 - r)),
+    ("rot180", lambda r, c: (BOARD_SIZE - 1 - r, BOARD_SIZE - 1 - c)),
+    ("rot270", lambda r, c: (BOARD_SIZE - 1 - c, r)),
+    ("flip_rows", lambda r, c: (BOARD_SIZE - 1 - r, c)),
+    ("flip_cols", lambda r, c: (r, BOARD_SIZE - 1 - c)),
+    ("transpose", lambda r, c: (c, r)),
+    ("anti_transpose", lambda r, c: (BOARD_SIZE - 1 - c, BOARD_SIZE - 1 - r)),
+)
+
+
+def find_symmetries(layout=BOARD_LAYOUT):
+    """Every grid transform of `layout` that is a card relabeling, identity first
+
+    :param layout: BOARD_SIZE rows of BOARD_SIZE cell labels, as BOARD_LAYOUT
+    :return: list of Symmetry
+    """
+    symmetries = []
+    for name, transform in GRID_TRANSFORMS:
+        label_map = _label_map(layout, transform)
+        if label_map is not None:
+            symmetries.append(_build_symmetry(name, transform, label_map))
+    return symmetries
+
+
+def _label_map(layout, transform):
+    """label -> label the transform carries it to, or None if that is not a one-to-one relabeling"""
+    label_map = {}
+    for r in range(BOARD_SIZE):
+        for c in range(BOARD_SIZE):
+            tr, tc = transform(r, c)
+            if label_map.setdefault(layout[r][c], layout[tr][tc]) != layout[tr][tc]:
+                return None
+    if len(set(label_map.values())) != len(label_map):
+        return None
+    return label_map
+
+
+def _build_symmetry(name, transform, label_map):
+    card_map = np.array([CARD_NAMES.index(label_map.get(card, card)) for card in CARD_NAMES], dtype=np.int64)
+    cell_source = np.empty(N_CELLS, dtype=np.int64)
+    for r in range(BOARD_SIZE):
+        for c in range(BOARD_SIZE):
+            tr, tc = transform(r, c)
+            cell_source[tr * BOARD_SIZE + tc] = r * BOARD_SIZE + c
+    # action = (type * N_CARDS + card) * N_CELLS + cell, see encode_action()
+    card_source = np.argsort(card_map)
+    rest_source = (np.arange(len(ACTION_TYPES))[:, None] * N_CARDS + card_source[None, :]).ravel()
+    action_source = (rest_source[:, None] * N_CELLS + cell_source[None, :]).ravel()
+    assert len(action_source) == N_ACTIONS
+    return Symmetry(name, card_map, cell_source, action_source)
+
+
+def transform_batch(symmetry, state_ary, policy_ary):
+    """Planes (b, BOARD_SIZE, BOARD_SIZE, n_planes) and policies (b, N_ACTIONS) seen through `symmetry`"""
+    b = len(state_ary)
+    flat = state_ary.reshape(b, N_CELLS, -1)[:, symmetry.cell_source]
+    return flat.reshape(state_ary.shape), policy_ary[:, symmetry.action_source]
+
+
+class SymmetryAugmenter:
+    """BatchLoader augment stage: each record is replaced by a random symmetric copy
+
+    Every plane is per cell (the hand, removal and belief planes only depend
+    on which cells the cards are printed on), so a symmetry moves them as a whole;
+    values are unchanged.
+    """
+
+    def __init__(self, symmetries, rng=np.random):
+        self.symmetries = symmetries
+        self.rng = rng
+
+    def __call__(self, state_ary, policy_ary, z_ary):
+        if len(self.symmetries) <= 1:
+            return state_ary, policy_ary, z_ary
+        choice = self.rng.randint(len(self.symmetries), size=len(state_ary))
+        for i, symmetry in enumerate(self.symmetries):
+            rows = np.nonzero(choice == i)[0]
+            if i == 0 or len(rows) == 0:  # identity first
+                continue
+            state_ary[rows], policy_ary[rows] = transform_batch(symmetry, state_ary[rows], policy_ary[rows])
+        return state_ary, policy_ary, z_ary
+
+    def __str__(self):
+        return ", ".join(symmetry.name for symmetry in self.symmetries)
@@ -0,0 +1,234 @@
+import numpy as np
+
+from connect4_zero.env.features import PLANE_SHAPE, N_PLANES
+from connect4_zero.env.sequence_env import (
+    BOARD_SIZE,
+    CARD_NAMES,
+    CORNERS,
+    LINES,
+    N_ACTIONS,
+    N_CARDS,
+    N_CELLS,
+    PLACE_TARGETS,
+    REMOVE_CARDS,
+    AgentState,
+    CardBelief,
+    Deck,
+    SequenceEnv,
+    SequenceState,
+    Winner,
+    ZOBRIST_SIDE,
+)
+
+HAND_SIZE = 7
+DECK_SIZE = 2 * N_CARDS  # double deck
+PLAYER_SIGN = np.array([1, -1], dtype=np.int8)  # chip value per agent id (0: blue, 1: red)
+
+# winner codes
+NO_WINNER = 0
+BLUE_WINS = 1
+RED_WINS = 2
+DRAW = 3
+WINNERS = {NO_WINNER: None, BLUE_WINS: Winner.blue, RED_WINS: Winner.red, DRAW: Winner.draw}
+
+_LINE_CELLS = np.array(LINES)  # (192, 5)
+_CORNER_CELLS = np.zeros(N_CELLS, dtype=bool)
+_CORNER_CELLS[[r * BOARD_SIZE + c for r, c in CORNERS]] = True
+
+
+class SequenceVecEnv:
+    """N Sequence games stepped in lockstep on stacked arrays
+
+    Same rules and action encoding as SequenceEnv (see encode_action), but
+    every method works on all games at once. A game whose player to move
+    has no legal move ends as a draw, the shortcut of
+    SequenceEnv.mover_stuck(). encode_observations() gives the network
+    input of every game in one array, and to_env() a SequenceEnv of one
+    game for the search to push()/pop() on.
+    """
+
+    def __init__(self, n_envs, seed=None):
+        self.n_envs = n_envs
+        self.rng = np.random.RandomState(seed)
+        self.chips = np.zeros((n_envs, BOARD_SIZE, BOARD_SIZE), dtype=np.int8)
+        self.hands = np.zeros((n_envs, 2, N_CARDS), dtype=np.int8)  # card counts
+        self.played = np.zeros((n_envs, N_CARDS), dtype=np.int8)  # discard pile card counts
+        self.decks = np.zeros((n_envs, DECK_SIZE), dtype=np.int16)  # card indices
+        self.deck_pos = np.zeros(n_envs, dtype=np.int16)  # next card to draw
+        self.current_player = np.zeros(n_envs, dtype=np.int8)
+        self.turn = np.zeros(n_envs, dtype=np.int32)
+        self.sequences = np.zeros((n_envs, 2), dtype=np.int16)
+        self.done = np.zeros(n_envs, dtype=bool)
+        self.winner = np.zeros(n_envs, dtype=np.int8)
+        self.reset()
+
+    def reset(self, indices=None):
+        """Start new games at `indices` (all games by default)"""
+        if indices is None:
+            indices = np.arange(self.n_envs)
+        indices = np.asarray(indices)
+        n = len(indices)
+
+        order = np.argsort(self.rng.rand(n, DECK_SIZE), axis=1)
+        self.decks[indices] = order % N_CARDS
+        self.hands[indices] = 0
+        for player_id in range(2):
+            dealt = self.decks[indices, player_id * HAND_SIZE:(player_id + 1) * HAND_SIZE]
+            rows = np.repeat(np.arange(n), HAND_SIZE)
+            hands = np.zeros((n, N_CARDS), dtype=np.int8)
+            np.add.at(hands, (rows, dealt.ravel()), 1)
+            self.hands[indices, player_id] = hands
+        self.deck_pos[indices] = 2 * HAND_SIZE
+
+        self.chips[indices] = 0
+        self.played[indices] = 0
+        self.current_player[indices] = 0
+        self.turn[indices] = 0
+        self.sequences[indices] = 0
+        self.done[indices] = False
+        self.winner[indices] = NO_WINNER
+        self.end_stuck(indices)
+        return self.chips
+
+    def step(self, actions, indices=None):
+        """Apply one encoded action per game; finished games are left unchanged
+
+        :param np.ndarray actions: indices from encode_action, one per game of `indices`
+        :param indices: games to step, all by default
+        :return: chips, rewards for the player who moved, done flags
+        """
+        if indices is None:
+            indices = np.arange(self.n_envs)
+        indices = np.asarray(indices)
+        actions = np.asarray(actions)
+        rewards = np.zeros(self.n_envs)
+        moving = ~self.done[indices]
+        live, actions = indices[moving], actions[moving]
+        if len(live) == 0:
+            return self.chips, rewards, self.done
+
+        rest, cells = np.divmod(actions, N_CELLS)
+        action_types, cards = np.divmod(rest, N_CARDS)
+        player = self.current_player[live]
+        flat_chips = self.chips.reshape(self.n_envs, N_CELLS)
+        flat_chips[live, cells] = np.where(action_types == 0, PLAYER_SIGN[player], 0)
+
+        # discard the played card and draw a replacement while the deck lasts
+        self.hands[live, player, cards] -= 1
+        self.played[live, cards] += 1
+        can_draw = self.deck_pos[live] < DECK_SIZE
+        drawers = live[can_draw]
+        drawn = self.decks[drawers, self.deck_pos[drawers]]
+        self.hands[drawers, self.current_player[drawers], drawn] += 1
+        self.deck_pos[drawers] += 1
+
+        self.sequences[live] = self.count_sequences(live)
+        blue_won = self.sequences[live, 0] >= 2
+        red_won = ~blue_won & (self.sequences[live, 1] >= 2)
+        no_cards = (self.deck_pos[live] >= DECK_SIZE) & (self.hands[live].sum(axis=(1, 2)) == 0)
+        drawn_game = ~blue_won & ~red_won & no_cards
+        self.winner[live[blue_won]] = BLUE_WINS
+        self.winner[live[red_won]] = RED_WINS
+        self.winner[live[drawn_game]] = DRAW
+        finished = blue_won | red_won | drawn_game
+        self.done[live] = finished
+
+        mover_won = self.winner[live] == player + 1
+        rewards[live] = np.where(
+            finished, np.where(mover_won, 1, -1), self.sequences[live, player] * 0.1
+        )
+
+        self.current_player[live] = 1 - player
+        self.turn[live] += 1
+        self.end_stuck(live)
+        return self.chips, rewards, self.done
+
+    def end_stuck(self, indices):
+        """Draw the unfinished games of `indices` whose player to move has no legal move"""
+        indices = indices[~self.done[indices]]
+        stuck = indices[~self.legal_action_mask(indices).any(axis=1)]
+        self.winner[stuck] = DRAW
+        self.done[stuck] = True
+
+    def count_sequences(self, indices=None):
+        """Completed 5-in-a-row lines per game and agent as a (len(indices), 2) array"""
+        if indices is None:
+            indices = np.arange(self.n_envs)
+        flat_chips = self.chips[indices].reshape(-1, 1, N_CELLS)
+        owned = (flat_chips == PLAYER_SIGN[None, :, None]) | _CORNER_CELLS  # (n, 2, 100)
+        return owned[:, :, _LINE_CELLS].all(axis=3).sum(axis=2)
+
+    def legal_action_mask(self, indices=None):
+        """(len(indices), N_ACTIONS) bool masks for the player to move in each game (all games by default)"""
+        if indices is None:
+            indices = np.arange(self.n_envs)
+        n = len(indices)
+        player = self.current_player[indices]
+        in_hand = self.hands[indices, player] > 0  # (n, 52)
+        flat_chips = self.chips[indices].reshape(n, N_CELLS)
+        empty = (flat_chips == 0) & ~_CORNER_CELLS
+        opponent = flat_chips == PLAYER_SIGN[1 - player][:, None]
+
+        place = in_hand[:, :, None] & PLACE_TARGETS[None] & empty[:, None, :]
+        remove = (in_hand & REMOVE_CARDS)[:, :, None] & opponent[:, None, :]
+        mask = np.concatenate([place, remove], axis=1).reshape(n, N_ACTIONS)
+        mask[self.done[indices]] = False
+        return mask
+
+    def unseen(self, player_ids):
+        """(N, N_CARDS) copies of each card agent player_ids[i] of game i has not seen (CardBelief.unseen)"""
+        ar = np.arange(self.n_envs)
+        return 2 - self.hands[ar, player_ids] - self.played
+
+    def encode_observations(self, out=None):
+        """features.encode_observation() of every game, as one (N, *PLANE_SHAPE) array"""
+        if out is None:
+            out = np.empty((self.n_envs,) + PLANE_SHAPE, dtype=np.float32)
+        ar = np.arange(self.n_envs)
+        me = self.current_player
+        flat_chips = self.chips.reshape(self.n_envs, N_CELLS)
+        own = flat_chips == PLAYER_SIGN[me][:, None]
+        opponent = flat_chips == PLAYER_SIGN[1 - me][:, None]
+        in_hand = self.hands[ar, me] > 0
+        empty = (flat_chips == 0) & ~_CORNER_CELLS
+        planes = out.reshape(self.n_envs, N_CELLS, N_PLANES)
+        planes[:, :, 0] = own
+        planes[:, :, 1] = opponent
+        planes[:, :, 2] = _CORNER_CELLS
+        planes[:, :, 3] = (in_hand[:, :, None] & PLACE_TARGETS[None]).any(axis=1) & empty
+        planes[:, :, 4] = (in_hand & REMOVE_CARDS).any(axis=1)[:, None] & opponent
+        unseen = self.unseen(me)
+        opponent_hand_size = self.hands[ar, 1 - me].sum(axis=1)
+        for i in range(self.n_envs):
+            planes[i, :, 5] = CardBelief.from_unseen(unseen[i]).cell_plane(int(opponent_hand_size[i]))
+        return out
+
+    def to_env(self, i):
+        """SequenceEnv in the position of game i, e.g. a search root"""
+        env = SequenceEnv.__new__(SequenceEnv)
+        state = env.state = SequenceState()
+        env.agents = [AgentState(player_id) for player_id in range(2)]
+        flat_chips = self.chips[i].ravel()
+        for player_id in range(2):
+            for idx in np.flatnonzero(flat_chips == PLAYER_SIGN[player_id]):
+                state.place_chip(player_id, *divmod(int(idx), BOARD_SIZE))
+            agent = env.agents[player_id]
+            for card_index in np.flatnonzero(self.hands[i, player_id]):
+                for _ in range(self.hands[i, player_id, card_index]):
+                    card = CARD_NAMES[card_index]
+                    state.toggle_hand_card(player_id, card, agent.hand.count(card))
+                    state.hand[card_index] = 1
+                    agent.hand.append(card)
+            agent.completed_seqs = int(self.sequences[i, player_id])
+            state.beliefs[player_id] = CardBelief.from_unseen(2 - self.hands[i, player_id] - self.played[i])
+        state.discard_pile = [CARD_NAMES[c] for c in np.repeat(np.arange(N_CARDS), self.played[i])]
+        state.current_player = int(self.current_player[i])
+        state.turn = int(self.turn[i])
+        if state.turn % 2:
+            state.zobrist ^= ZOBRIST_SIDE
+        env.deck = Deck.__new__(Deck)
+        env.deck.cards = [CARD_NAMES[c] for c in self.decks[i, self.deck_pos[i]:][::-1]]  # deal() pops the end
+        env.done = bool(self.done[i])
+        env.winner = WINNERS[int(self.winner[i])]
+        env.history = []
+        return env
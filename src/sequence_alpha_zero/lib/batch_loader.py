@@ -0,0 +1,96 @@
+from logging import getLogger
+from queue import Queue, Full
+from threading import Event, Lock, Thread
+from time import time
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+
+class BatchLoader:
+    """Endless generator of training batches read from a ReplayBuffer by background threads
+
+    Each pass over the buffer visits its records in a new random order
+    (the size is re-read per pass, so refreshed data joins the next one).
+    Threads decode, optionally augment, and queue up to `prefetch` batches,
+    so fit_generator rarely waits on Python preprocessing; wait_sec tells
+    how long it did.
+
+    :param augment: called as augment(state_ary, policy_ary, z_ary) -> the same triple
+    """
+
+    def __init__(self, buffer, batch_size, prefetch=4, thread_num=2, augment=None):
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.thread_num = thread_num
+        self.augment = augment
+        self.queue = Queue(maxsize=prefetch)
+        self.plan_lock = Lock()
+        self.plan = self.index_plan()
+        self.stopped = Event()
+        self.threads = []
+        self.wait_sec = 0
+
+    def start(self):
+        self.stopped.clear()
+        self.threads = [Thread(target=self.run, name=f"batch_loader_{i}", daemon=True)
+                        for i in range(self.thread_num)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def index_plan(self):
+        """Ring positions of each batch, one shuffled pass after another; None while the buffer is too small"""
+        while True:
+            size = len(self.buffer)
+            steps = size // self.batch_size
+            if steps == 0:
+                yield None
+                continue
+            order = np.random.permutation(size)
+            for step in range(steps):
+                # sorted, so a batch reads the memory-mapped records front to back
+                indices = np.sort(order[step * self.batch_size:(step + 1) * self.batch_size])
+                yield self.buffer.positions(indices)
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                with self.plan_lock:
+                    positions = next(self.plan)
+                if positions is None:
+                    self.stopped.wait(1)
+                    continue
+                state_ary, policy_ary, z_ary = self.buffer.read(positions)
+                if self.augment is not None:
+                    state_ary, policy_ary, z_ary = self.augment(state_ary, policy_ary, z_ary)
+                self.put((state_ary, [policy_ary, z_ary]))
+        except Exception as e:
+            logger.exception("batch loader failed")
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Full:
+                continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time()
+        item = self.queue.get()
+        self.wait_sec += time() - start
+        if isinstance(item, Exception):
+            raise item
+        return item
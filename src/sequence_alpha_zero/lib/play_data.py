@@ -0,0 +1,327 @@
+import hashlib
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from glob import escape, glob
+from logging import getLogger
+from multiprocessing import get_context
+
+import numpy as np
+
+from connect4_zero.config import ResourceConfig
+from connect4_zero.env.features import PLANE_SHAPE, encode_record, quantize_planes, dequantize_planes
+from connect4_zero.env.sequence_env import N_ACTIONS
+from connect4_zero.lib.data_helper import read_game_data_from_file
+
+logger = getLogger(__name__)
+
+# File: header, then one chunk per appended batch of moves (usually a game).
+# Chunk: header, then the payload (zlib-compressed if FLAG_COMPRESSED):
+#   planes int8 (n, *PLANE_SHAPE) quantized by quantize_planes, z int8 (n,),
+#   policy_offsets uint32 (n + 1,), policy_index uint16 (m,), policy_value float16 (m,)
+# where record i's policy is the nonzero entries policy_offsets[i]:policy_offsets[i + 1].
+FILE_HEADER = struct.Struct("<4sHBBB")
+FILE_MAGIC = b"SQPD"
+FILE_VERSION = 1
+CHUNK_HEADER = struct.Struct("<4sIIII")  # magic, records, policy entries, flags, payload bytes
+CHUNK_MAGIC = b"CHNK"
+FLAG_COMPRESSED = 1
+PART_SUFFIX = ".part"
+
+_PLANE_SIZE = int(np.prod(PLANE_SHAPE))
+
+
+class PlayDataWriter:
+    """Appends games to a play data file as they finish
+
+    Data goes to `path` + PART_SUFFIX and is flushed after every chunk;
+    close() renames it to `path`, so readers globbing finished files never
+    see a file that is still growing.
+    """
+
+    def __init__(self, path, compress=True):
+        self.path = path
+        self.compress = compress
+        self.record_num = 0
+        self.game_num = 0
+        self.file = open(path + PART_SUFFIX, "wb")
+        self.file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, *PLANE_SHAPE))
+
+    def append_game(self, moves):
+        """
+        :param moves: [observation_record, policy over all actions, z] per move, like SelfPlayWorker.buffer
+        """
+        n = len(moves)
+        if n == 0:
+            return
+        planes = np.empty((n,) + PLANE_SHAPE, dtype=np.float32)
+        z = np.empty(n, dtype=np.int8)
+        offsets = np.zeros(n + 1, dtype=np.uint32)
+        indexes, values = [], []
+        for i, (record, policy, z_) in enumerate(moves):
+            encode_record(record, out=planes[i])
+            policy = np.asarray(policy, dtype=np.float32)
+            idx = np.flatnonzero(policy)
+            indexes.append(idx.astype(np.uint16))
+            values.append(policy[idx].astype(np.float16))
+            offsets[i + 1] = offsets[i] + len(idx)
+            z[i] = z_
+        self.write_chunk(quantize_planes(planes), z, offsets, np.concatenate(indexes), np.concatenate(values))
+        self.game_num += 1
+
+    def write_chunk(self, planes, z, offsets, policy_index, policy_value):
+        payload = b"".join(a.tobytes() for a in (planes, z, offsets, policy_index, policy_value))
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload)
+            flags |= FLAG_COMPRESSED
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(z), len(policy_index), flags, len(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        self.record_num += len(z)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + PART_SUFFIX, self.path)
+
+
+class PlayDataReader:
+    """Random access to the records of a play data file
+
+    Opening reads only the chunk headers to build the record index; a
+    truncated last chunk (e.g. from a crashed writer) is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []  # (payload offset, records, policy entries, flags, payload bytes)
+        self.starts = []  # index of the first record of each chunk
+        self.record_num = 0
+        self._cached = (None, None)  # last decoded chunk: (chunk id, arrays)
+        with open(path, "rb") as f:
+            header = f.read(FILE_HEADER.size)
+            if len(header) < FILE_HEADER.size:
+                raise ValueError(f"{path}: not a play data file")
+            magic, version, *shape = FILE_HEADER.unpack(header)
+            if magic != FILE_MAGIC or version != FILE_VERSION or tuple(shape) != PLANE_SHAPE:
+                raise ValueError(f"{path}: unsupported play data {magic} v{version} planes {shape}")
+            size = os.fstat(f.fileno()).st_size
+            pos = FILE_HEADER.size
+            while pos + CHUNK_HEADER.size <= size:
+                f.seek(pos)
+                magic, n, m, flags, nbytes = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+                payload_pos = pos + CHUNK_HEADER.size
+                if magic != CHUNK_MAGIC or payload_pos + nbytes > size:
+                    logger.warning(f"{path}: ignoring a truncated chunk at {pos}")
+                    break
+                self.chunks.append((payload_pos, n, m, flags, nbytes))
+                self.starts.append(self.record_num)
+                self.record_num += n
+                pos = payload_pos + nbytes
+
+    def __len__(self):
+        return self.record_num
+
+    def __getitem__(self, i):
+        """(planes float32 PLANE_SHAPE, dense policy float32 (N_ACTIONS,), z) of record i"""
+        if not 0 <= i < self.record_num:
+            raise IndexError(i)
+        chunk_id = bisect_right(self.starts, i) - 1
+        planes, z, offsets, policy_index, policy_value = self.read_chunk(chunk_id)
+        j = i - self.starts[chunk_id]
+        policy = np.zeros(N_ACTIONS, dtype=np.float32)
+        sl = slice(offsets[j], offsets[j + 1])
+        policy[policy_index[sl]] = policy_value[sl]
+        return dequantize_planes(planes[j]), policy, int(z[j])
+
+    def read_chunk(self, chunk_id):
+        """Raw arrays of a chunk, as laid out in the file"""
+        if self._cached[0] == chunk_id:
+            return self._cached[1]
+        pos, n, m, flags, nbytes = self.chunks[chunk_id]
+        with open(self.path, "rb") as f:
+            f.seek(pos)
+            payload = f.read(nbytes)
+        if flags & FLAG_COMPRESSED:
+            payload = zlib.decompress(payload)
+        arrays = []
+        start = 0
+        for dtype, count, shape in ((np.int8, n * _PLANE_SIZE, (n,) + PLANE_SHAPE), (np.int8, n, (n,)),
+                                    (np.uint32, n + 1, (n + 1,)), (np.uint16, m, (m,)), (np.float16, m, (m,))):
+            ary = np.frombuffer(payload, dtype=dtype, count=count, offset=start).reshape(shape)
+            arrays.append(ary)
+            start += ary.nbytes
+        self._cached = (chunk_id, arrays)
+        return arrays
+
+    def read_all(self):
+        """(state_ary, policy_ary, z_ary) of every record, ready for training"""
+        state_ary = np.empty((self.record_num,) + PLANE_SHAPE, dtype=np.float32)
+        policy_ary = np.zeros((self.record_num, N_ACTIONS), dtype=np.float32)
+        z_ary = np.empty(self.record_num, dtype=np.float32)
+        for chunk_id, start in enumerate(self.starts):
+            planes, z, offsets, policy_index, policy_value = self.read_chunk(chunk_id)
+            n = len(z)
+            dequantize_planes(planes, out=state_ary[start:start + n])
+            z_ary[start:start + n] = z
+            rows = np.repeat(np.arange(start, start + n), np.diff(offsets.astype(np.int64)))
+            policy_ary[rows, policy_index] = policy_value
+        return state_ary, policy_ary, z_ary
+
+
+def policy_rows(offsets, policy_index, policy_value, k):
+    """Sparse chunk policies -> (n, k) index and value rows, keeping the k most visited moves"""
+    n = len(offsets) - 1
+    index_rows = np.zeros((n, k), dtype=np.uint16)
+    value_rows = np.zeros((n, k), dtype=np.float16)
+    for j in range(n):
+        idx = policy_index[offsets[j]:offsets[j + 1]]
+        val = policy_value[offsets[j]:offsets[j + 1]]
+        if len(idx) > k:
+            top = np.argsort(val)[-k:]
+            idx, val = idx[top], val[top]
+            val = val / np.sum(val, dtype=np.float32)
+        index_rows[j, :len(idx)] = idx
+        value_rows[j, :len(idx)] = val
+    return index_rows, value_rows
+
+
+def file_digest(path):
+    m = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            m.update(block)
+    return m.hexdigest()
+
+
+def training_cache_path(path, policy_entries):
+    return f"{path}.k{policy_entries}.npz"
+
+
+def prepare_training_arrays(path, policy_entries):
+    """Fixed-width training arrays of a play data file, cached next to it
+
+    The cache holds the digest of the file it was made from, so a stale or
+    foreign cache is rebuilt rather than trusted.
+    :return: dict of planes (n, *PLANE_SHAPE) int8, z (n,) int8, policy_index (n, k) uint16,
+        policy_value (n, k) float16
+    """
+    digest = file_digest(path)
+    cache_path = training_cache_path(path, policy_entries)
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if str(cache["digest"]) == digest and cache["planes"].shape[1:] == PLANE_SHAPE:
+                    return {key: cache[key] for key in ("planes", "z", "policy_index", "policy_value")}
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"ignoring broken cache {cache_path}: {e}")
+
+    reader = PlayDataReader(path)
+    parts = [reader.read_chunk(chunk_id) for chunk_id in range(len(reader.chunks))]
+    if parts:
+        planes = np.concatenate([planes for planes, _, _, _, _ in parts])
+        z = np.concatenate([z for _, z, _, _, _ in parts])
+        rows = [policy_rows(offsets, idx, val, policy_entries) for _, _, offsets, idx, val in parts]
+        policy_index = np.concatenate([index_rows for index_rows, _ in rows])
+        policy_value = np.concatenate([value_rows for _, value_rows in rows])
+    else:
+        planes = np.empty((0,) + PLANE_SHAPE, dtype=np.int8)
+        z = np.empty(0, dtype=np.int8)
+        policy_index = np.empty((0, policy_entries), dtype=np.uint16)
+        policy_value = np.empty((0, policy_entries), dtype=np.float16)
+    arrays = dict(planes=planes, z=z, policy_index=policy_index, policy_value=policy_value)
+
+    tmp_path = cache_path + ".tmp.npz"
+    np.savez(tmp_path, digest=np.array(digest), **arrays)
+    os.replace(tmp_path, cache_path)
+    return arrays
+
+
+def prepare_training_arrays_parallel(paths, policy_entries, process_num):
+    """prepare_training_arrays() of each path, in order, using a process pool for several files"""
+    if process_num <= 1 or len(paths) <= 1:
+        return [prepare_training_arrays(path, policy_entries) for path in paths]
+    with spawn_pool(process_num) as pool:
+        return pool.starmap(prepare_training_arrays, [(path, policy_entries) for path in paths])
+
+
+def spawn_pool(process_num):
+    """Process pool whose workers start fresh instead of forking
+
+    The optimizer calls into it with the TF session and BatchLoader threads
+    running, and a fork child may inherit a lock held by one of those threads.
+    """
+    return get_context("spawn").Pool(process_num)
+
+
+def remove_play_data_file(path):
+    """Remove a play data file together with its training caches"""
+    for cache_path in glob(escape(path) + ".k*.npz"):
+        os.remove(cache_path)
+    os.remove(path)
+
+
+def recover_part_file(part_path):
+    """Finish a file a crashed PlayDataWriter left behind: keep its whole chunks, or remove it if there are none
+
+    :return: number of records kept
+    """
+    path = part_path[:-len(PART_SUFFIX)]
+    try:
+        reader = PlayDataReader(part_path)
+    except (OSError, ValueError) as e:
+        logger.warning(f"removing unreadable {part_path}: {e}")
+        os.remove(part_path)
+        return 0
+    if reader.record_num == 0:
+        os.remove(part_path)
+        return 0
+    payload_pos, _, _, _, nbytes = reader.chunks[-1]
+    os.truncate(part_path, payload_pos + nbytes)  # drop the chunk the crash cut short
+    os.replace(part_path, path)
+    logger.info(f"recovered {reader.record_num} records of {len(reader.chunks)} games to {path}")
+    return reader.record_num
+
+
+def convert_json_play_data(rc: ResourceConfig, compress=True, remove=False, process_num=4):
+    """Rewrite every play_*.json in the play data dir in the binary format, a file per process
+
+    The JSON files must hold observation_record() observations; files from
+    before those records are skipped with a warning.
+    """
+    pattern = os.path.join(rc.play_data_dir, rc.json_play_data_filename_tmpl % "*")
+    jobs = []
+    for json_path in sorted(glob(pattern)):
+        path = os.path.splitext(json_path)[0] + os.path.splitext(rc.play_data_filename_tmpl)[1]
+        if not os.path.exists(path):
+            jobs.append((json_path, path))
+    if not jobs:
+        return
+    args = [(json_path, path, compress) for json_path, path in jobs]
+    if process_num <= 1 or len(jobs) <= 1:
+        results = [convert_json_file(*a) for a in args]
+    else:
+        with spawn_pool(process_num) as pool:
+            results = pool.starmap(convert_json_file, args)
+    for (json_path, path), record_num in zip(jobs, results):
+        if record_num is None:
+            continue
+        logger.info(f"converted {json_path} to {path} ({record_num} records)")
+        if remove:
+            os.remove(json_path)
+
+
+def convert_json_file(json_path, path, compress=True):
+    """Write one JSON play data file in the binary format; returns the record count, or None on failure"""
+    try:
+        data = read_game_data_from_file(json_path)
+        writer = PlayDataWriter(path, compress=compress)
+        writer.append_game(data)
+        writer.close()
+    except (ValueError, TypeError) as e:
+        logger.warning(f"can not convert {json_path}: {e}")
+        if os.path.exists(path + PART_SUFFIX):
+            os.remove(path + PART_SUFFIX)
+        return None
+    return writer.record_num
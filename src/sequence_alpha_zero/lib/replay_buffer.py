@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+from logging import getLogger
+from threading import RLock
+
+import numpy as np
+
+from connect4_zero.env.features import PLANE_SHAPE, dequantize_planes
+from connect4_zero.env.sequence_env import N_ACTIONS
+from connect4_zero.lib.play_data import policy_rows, prepare_training_arrays
+
+logger = getLogger(__name__)
+
+META_FILENAME = "meta.json"
+LAYOUT_VERSION = 2  # bump when the arrays change, so an old buffer is started over
+
+
+class ReplayBuffer:
+    """Fixed-capacity ring of training records in memory-mapped files
+
+    Records keep the play data encoding: int8 planes, the value target, and
+    the policy as its `policy_entries` largest (action, float16 probability)
+    pairs. Adding a record overwrites the oldest one once the ring is
+    full, so a refresh costs only the new records and the replay window
+    can be larger than RAM.
+
+    With dedup, a record whose planes are already in the ring is merged
+    into the stored one instead: the targets become the average over all
+    occurrences and `count` keeps how many there were, so positions that
+    recur in many games (openings) take one slot and one sample per pass.
+
+    :ivar head: ring position the next record is written to
+    :ivar size: number of valid records, ending just before head
+    :ivar merged: records merged into an earlier occurrence so far
+    """
+
+    def __init__(self, buffer_dir, capacity, policy_entries, dedup=True):
+        self.buffer_dir = buffer_dir
+        os.makedirs(buffer_dir, exist_ok=True)
+        meta = self.read_meta()
+        if meta is not None and (meta.get("layout") != LAYOUT_VERSION or meta["capacity"] != capacity
+                                 or meta["policy_entries"] != policy_entries
+                                 or tuple(meta["plane_shape"]) != PLANE_SHAPE):
+            logger.warning(f"replay buffer layout changed, starting a new one in {buffer_dir}")
+            meta = None
+        mode = "r+" if meta is not None else "w+"
+        self.capacity = capacity
+        self.policy_entries = policy_entries
+        self.dedup = dedup
+        self.lock = RLock()  # mutation vs. BatchLoader reads, so no batch sees a half-written record
+        self.planes = self.open_array("planes.npy", mode, np.int8, (capacity,) + PLANE_SHAPE)
+        self.z = self.open_array("z.npy", mode, np.float16, (capacity,))
+        self.policy_index = self.open_array("policy_index.npy", mode, np.uint16, (capacity, policy_entries))
+        self.policy_value = self.open_array("policy_value.npy", mode, np.float16, (capacity, policy_entries))
+        self.keys = self.open_array("keys.npy", mode, np.uint64, (capacity,))
+        self.count = self.open_array("count.npy", mode, np.int32, (capacity,))
+        self.head = meta["head"] if meta else 0
+        self.size = meta["size"] if meta else 0
+        self.merged = meta["merged"] if meta else 0
+        self.ingested = set(meta["ingested"]) if meta else set()  # play data files already added
+        # position key -> ring position of the record holding it
+        self.key_positions = {int(self.keys[pos]): int(pos) for pos in self.positions(np.arange(self.size))}
+
+    def open_array(self, filename, mode, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(self.buffer_dir, filename), mode=mode,
+                                         dtype=dtype, shape=shape)
+
+    def read_meta(self):
+        path = os.path.join(self.buffer_dir, META_FILENAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rt") as f:
+            return json.load(f)
+
+    def __len__(self):
+        return self.size
+
+    def add_file(self, path, arrays=None):
+        """Add every record of a play data file once; returns the number of records added
+
+        :param dict arrays: prepare_training_arrays() of the file if already at hand
+        """
+        name = os.path.basename(path)
+        if name in self.ingested:
+            return 0
+        if arrays is None:
+            arrays = prepare_training_arrays(path, self.policy_entries)
+        self.add_rows(arrays["planes"], arrays["z"], arrays["policy_index"], arrays["policy_value"])
+        self.ingested.add(name)
+        return len(arrays["z"])
+
+    def add_chunk(self, planes, z, offsets, policy_index, policy_value):
+        """Append records laid out like a play data chunk, evicting the oldest ones"""
+        self.add_rows(planes, z, *policy_rows(offsets, policy_index, policy_value, self.policy_entries))
+
+    def add_rows(self, planes, z, index_rows, value_rows):
+        """Append records whose policies are already (n, policy_entries) rows"""
+        with self.lock:
+            n = len(z)
+            if not self.dedup:
+                if n > self.capacity:  # only the newest records fit
+                    planes, z = planes[n - self.capacity:], z[n - self.capacity:]
+                    index_rows, value_rows = index_rows[n - self.capacity:], value_rows[n - self.capacity:]
+                    n = self.capacity
+                positions = (self.head + np.arange(n)) % self.capacity
+                self.write(positions, position_keys(planes), planes, z, index_rows, value_rows)
+                return
+            keys = position_keys(planes)
+            for i in range(n):
+                pos = self.key_positions.get(int(keys[i]))
+                if pos is None:
+                    self.write(np.array([self.head]), keys[i:i + 1], planes[i:i + 1], z[i:i + 1],
+                               index_rows[i:i + 1], value_rows[i:i + 1])
+                else:
+                    self.merge(pos, z[i], index_rows[i], value_rows[i])
+
+    def write(self, positions, keys, planes, z, index_rows, value_rows):
+        """Store new records at head, evicting the oldest ones; call with the lock held"""
+        n = len(positions)
+        if self.size + n > self.capacity:
+            for pos in positions[self.capacity - self.size:]:  # the rest were free
+                key = int(self.keys[pos])
+                if self.key_positions.get(key) == pos:
+                    del self.key_positions[key]
+        self.planes[positions] = planes
+        self.z[positions] = z
+        self.policy_index[positions] = index_rows
+        self.policy_value[positions] = value_rows
+        self.keys[positions] = keys
+        self.count[positions] = 1
+        for pos, key in zip(positions, keys):
+            self.key_positions[int(key)] = int(pos)
+        self.head = int((self.head + n) % self.capacity)
+        self.size = min(self.size + n, self.capacity)
+
+    def merge(self, pos, z, index_row, value_row):
+        """Fold one more occurrence into the record at `pos`, averaging the targets
+
+        Every occurrence was searched with the same number of simulations, so
+        weighting by occurrence is weighting by visit count.
+        """
+        with self.lock:
+            n = int(self.count[pos])
+            self.z[pos] = (float(self.z[pos]) * n + float(z)) / (n + 1)
+            old_value = self.policy_value[pos].astype(np.float32)
+            new_value = value_row.astype(np.float32)
+            actions = np.concatenate([self.policy_index[pos][old_value > 0], index_row[new_value > 0]])
+            weights = np.concatenate([old_value[old_value > 0] * n, new_value[new_value > 0]]) / (n + 1)
+            actions, inverse = np.unique(actions, return_inverse=True)
+            weights = np.bincount(inverse, weights=weights)
+            if len(actions) > self.policy_entries:
+                top = np.argsort(weights)[-self.policy_entries:]
+                actions, weights = actions[top], weights[top] / np.sum(weights[top])
+            self.policy_index[pos] = 0
+            self.policy_value[pos] = 0
+            self.policy_index[pos, :len(actions)] = actions
+            self.policy_value[pos, :len(actions)] = weights
+            self.count[pos] = n + 1
+            self.merged += 1
+
+    def forget_missing(self, names):
+        """Drop ingested names not in `names`, keeping the metadata bounded as play data rotates"""
+        self.ingested &= set(names)
+
+    def flush(self):
+        """Write the arrays and then the metadata that makes the new records valid"""
+        with self.lock:
+            for ary in (self.planes, self.z, self.policy_index, self.policy_value, self.keys, self.count):
+                ary.flush()
+            meta = dict(layout=LAYOUT_VERSION, capacity=self.capacity, policy_entries=self.policy_entries,
+                        plane_shape=list(PLANE_SHAPE), head=self.head, size=self.size, merged=self.merged,
+                        ingested=sorted(self.ingested))
+            path = os.path.join(self.buffer_dir, META_FILENAME)
+            with open(path + ".tmp", "wt") as f:
+                json.dump(meta, f)
+            os.replace(path + ".tmp", path)
+
+    def positions(self, indices):
+        """Ring positions of records 0 (oldest) .. size - 1 (newest)"""
+        return (self.head - self.size + np.asarray(indices)) % self.capacity
+
+    def batch(self, indices):
+        """(state_ary, policy_ary, z_ary) of the given records, ready for training"""
+        return self.read(self.positions(indices))
+
+    def read(self, positions):
+        """batch() by ring positions, which stay put while records are added"""
+        with self.lock:  # copy the records out, then decode without holding the lock
+            planes = self.planes[positions]
+            idx = self.policy_index[positions]
+            val = self.policy_value[positions]
+            z = self.z[positions]
+        state_ary = dequantize_planes(planes)
+        policy_ary = np.zeros((len(positions), N_ACTIONS), dtype=np.float32)
+        used = val > 0
+        policy_ary[np.nonzero(used)[0], idx[used]] = val[used]
+        return state_ary, policy_ary, z.astype(np.float32)
+
+
+def position_keys(planes):
+    """64-bit hash of each record's int8 planes, which are the whole network input"""
+    planes = np.ascontiguousarray(planes)
+    return np.array([int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), "little")
+                     for row in planes], dtype=np.uint64)
@@ -7,7 +7,7 @@ from .config import Config
 
 logger = getLogger(__name__)
 
-CMD_LIST = ['self', 'opt', 'eval', 'play_gui']
+CMD_LIST = ['self', 'opt', 'eval', 'play_gui', 'convert_data', 'symmetry']
 
 
 def create_parser():
@@ -16,11 +16,16 @@ def create_parser():
     parser.add_argument("--new", help="run from new best model", action="store_true")
     parser.add_argument("--type", help="use normal setting", default="normal")
     parser.add_argument("--total-step", help="set TrainerConfig.start_total_steps", type=int)
+    parser.add_argument("--workers", help="number of self-play processes", type=int, default=1)
+    parser.add_argument("--lockstep-games", help="games searched in lockstep per self-play process (0: off)",
+                        type=int, default=0)
     return parser
 
 
 def setup(config: Config, args):
     config.opts.new = args.new
+    config.opts.workers = args.workers
+    config.opts.lockstep_games = args.lockstep_games
     if args.total_step is not None:
         config.trainer.start_total_steps = args.total_step
     config.resource.create_directories()
@@ -49,3 +54,12 @@ def start():
     elif args.cmd == 'play_gui':
         from .play_game import gui
         return gui.start(config)
+    elif args.cmd == 'convert_data':
+        from .lib import play_data
+        return play_data.convert_json_play_data(config.resource, compress=config.play_data.compress,
+                                                process_num=config.trainer.convert_process_num)
+    elif args.cmd == 'symmetry':
+        from .env.symmetry import find_symmetries
+        symmetries = find_symmetries()
+        logger.info(f"board symmetries: {', '.join(symmetry.name for symmetry in symmetries)}")
+        return symmetries
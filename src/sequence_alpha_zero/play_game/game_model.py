@@ -30,7 +30,7 @@ class PlayWithHuman:
         return model
 
     def move_by_ai(self, env):
-        action = self.ai.action(env.board)
+        action = self.ai.action(env)
 
         self.last_history = self.ai.ask_thought_about(env.observation)
         self.last_evaluation = self.last_history.values[self.last_history.action]
@@ -3,10 +3,11 @@ from logging import getLogger
 from random import random
 from time import sleep
 
-from connect4_zero.agent.model_sequence import Connect4Model
+from connect4_zero.agent.eval_cache import EvaluationCache
+from connect4_zero.agent.model_sequence import SequenceModel
 from connect4_zero.agent.player_sequence import Connect4Player
 from connect4_zero.config import Config
-from connect4_zero.env.sequence_env import Connect4Env, Winner, Player
+from connect4_zero.env.sequence_env import SequenceEnv, Winner, Player
 from connect4_zero.lib import tf_util
 from connect4_zero.lib.data_helper import get_next_generation_model_dirs
 from connect4_zero.lib.model_helpler import save_as_best_model, load_best_model_weight
@@ -27,6 +28,8 @@ class EvaluateWorker:
         """
         self.config = config
         self.best_model = None
+        # keyed by model digest, so the best model's evaluations survive across challengers
+        self.cache = EvaluationCache(config.eval.play_config.eval_cache_max_bytes)
 
     def start(self):
         self.best_model = self.load_best_model()
@@ -46,11 +49,11 @@ class EvaluateWorker:
         winning_rate = 0
         for game_idx in range(self.config.eval.game_num):
             # ng_win := if ng_model win -> 1, lose -> 0, draw -> None
-            ng_win, white_is_best = self.play_game(self.best_model, ng_model)
+            ng_win, red_is_best = self.play_game(self.best_model, ng_model)
             if ng_win is not None:
                 results.append(ng_win)
                 winning_rate = sum(results) / len(results)
-            logger.debug(f"game {game_idx}: ng_win={ng_win} white_is_best_model={white_is_best} "
+            logger.debug(f"game {game_idx}: ng_win={ng_win} red_is_best_model={red_is_best} "
                          f"winning rate {winning_rate*100:.1f}%")
             if results.count(0) >= self.config.eval.game_num * (1-self.config.eval.replace_rate):
                 logger.debug(f"lose count reach {results.count(0)} so give up challenge")
@@ -63,43 +66,47 @@ class EvaluateWorker:
             winning_rate = sum(results) / len(results)
         else:
             winning_rate = 0
-        logger.debug(f"winning rate {winning_rate*100:.1f}%")
+        logger.debug(f"winning rate {winning_rate*100:.1f}% evaluation cache: {self.cache}")
         return winning_rate >= self.config.eval.replace_rate
 
     def play_game(self, best_model, ng_model):
-        env = Connect4Env().reset()
-
-        best_player = Connect4Player(self.config, best_model, play_config=self.config.eval.play_config)
-        ng_player = Connect4Player(self.config, ng_model, play_config=self.config.eval.play_config)
-        best_is_white = random() < 0.5
-        if not best_is_white:
-            black, white = best_player, ng_player
+        env = SequenceEnv()
+
+        best_player = Connect4Player(self.config, best_model, play_config=self.config.eval.play_config,
+                                     cache=self.cache)
+        ng_player = Connect4Player(self.config, ng_model, play_config=self.config.eval.play_config,
+                                   cache=self.cache)
+        best_is_red = random() < 0.5
+        if not best_is_red:
+            blue, red = best_player, ng_player
         else:
-            black, white = ng_player, best_player
+            blue, red = ng_player, best_player
 
         env.reset()
         while not env.done:
-            if env.player_turn() == Player.black:
-                action = black.action(env.board)
+            if env.mover_stuck():
+                break  # drawn, see SequenceEnv.mover_stuck()
+            if env.player_turn() == Player.blue:
+                action = blue.action(env)
             else:
-                action = white.action(env.board)
+                action = red.action(env)
             env.step(action)
 
         ng_win = None
-        if env.winner == Winner.white:
-            if best_is_white:
+        if env.winner == Winner.red:
+            if best_is_red:
                 ng_win = 0
             else:
                 ng_win = 1
-        elif env.winner == Winner.black:
-            if best_is_white:
+        elif env.winner == Winner.blue:
+            if best_is_red:
                 ng_win = 1
             else:
                 ng_win = 0
-        return ng_win, best_is_white
+        return ng_win, best_is_red
 
     def load_best_model(self):
-        model = Connect4Model(self.config)
+        model = SequenceModel(self.config)
         load_best_model_weight(model)
         return model
 
@@ -114,7 +121,7 @@ class EvaluateWorker:
         model_dir = dirs[-1] if self.config.eval.evaluate_latest_first else dirs[0]
         config_path = os.path.join(model_dir, rc.next_generation_model_config_filename)
         weight_path = os.path.join(model_dir, rc.next_generation_model_weight_filename)
-        model = Connect4Model(self.config)
+        model = SequenceModel(self.config)
         model.load(config_path, weight_path)
         return model, model_dir
 
@@ -4,17 +4,17 @@ from logging import getLogger
 from time import sleep
 
 import keras.backend as K
-import numpy as np
 from keras.optimizers import SGD
 
-from connect4_zero.agent.model_sequence import Connect4Model, objective_function_for_policy, \
-    objective_function_for_value
+from connect4_zero.agent.model_sequence import SequenceModel
 from connect4_zero.config import Config
+from connect4_zero.env.symmetry import find_symmetries, SymmetryAugmenter
 from connect4_zero.lib import tf_util
-from connect4_zero.lib.data_helper import get_game_data_filenames, read_game_data_from_file, \
-    get_next_generation_model_dirs
+from connect4_zero.lib.data_helper import get_game_data_filenames, get_next_generation_model_dirs
 from connect4_zero.lib.model_helpler import load_best_model_weight
-from connect4_zero.env.sequence_env import Connect4Env, Player
+from connect4_zero.lib.batch_loader import BatchLoader
+from connect4_zero.lib.play_data import prepare_training_arrays_parallel
+from connect4_zero.lib.replay_buffer import ReplayBuffer
 
 
 logger = getLogger(__name__)
@@ -28,16 +28,31 @@ def start(config: Config):
 class OptimizeWorker:
     def __init__(self, config: Config):
         self.config = config
-        self.model = None  # type: Connect4Model
-        self.loaded_filenames = set()
-        self.loaded_data = {}
-        self.dataset = None
+        self.model = None  # type: SequenceModel
+        self.buffer = None  # type: ReplayBuffer
+        self.loader = None  # type: BatchLoader
         self.optimizer = None
 
     def start(self):
         self.model = self.load_model()
+        tc = self.config.trainer
+        self.buffer = ReplayBuffer(self.config.resource.replay_buffer_dir, tc.replay_buffer_size,
+                                   tc.replay_policy_entries, dedup=tc.replay_dedup)
+        self.loader = BatchLoader(self.buffer, tc.batch_size, prefetch=tc.prefetch_batches,
+                                  thread_num=tc.loader_thread_num, augment=self.make_augment()).start()
         self.training()
 
+    def make_augment(self):
+        if not self.config.trainer.augment_symmetry:
+            return None
+        symmetries = find_symmetries()
+        if len(symmetries) <= 1:
+            logger.info("the board layout has no symmetry besides the identity, training without augmentation")
+            return None
+        augment = SymmetryAugmenter(symmetries)
+        logger.info(f"augmenting training batches with board symmetries: {augment}")
+        return augment
+
     def training(self):
         self.compile_model()
         last_load_data_step = last_save_step = total_steps = self.config.trainer.start_total_steps
@@ -63,16 +78,16 @@ class OptimizeWorker:
 
     def train_epoch(self, epochs):
         tc = self.config.trainer
-        state_ary, policy_ary, z_ary = self.dataset
-        self.model.model.fit(state_ary, [policy_ary, z_ary],
-                             batch_size=tc.batch_size,
-                             epochs=epochs)
-        steps = (state_ary.shape[0] // tc.batch_size) * epochs
-        return steps
+        steps_per_epoch = self.dataset_size // tc.batch_size
+        wait_sec = self.loader.wait_sec
+        self.model.model.fit_generator(self.loader, steps_per_epoch=steps_per_epoch, epochs=epochs)
+        logger.debug(f"waited {self.loader.wait_sec - wait_sec:.1f} sec for batches "
+                     f"in {steps_per_epoch * epochs} steps")
+        return steps_per_epoch * epochs
 
     def compile_model(self):
         self.optimizer = SGD(lr=1e-2, momentum=0.9)
-        losses = [objective_function_for_policy, objective_function_for_value]
+        losses = [SequenceModel.objective_function_for_policy, SequenceModel.objective_function_for_value]
         self.model.model.compile(optimizer=self.optimizer, loss=losses)
 
     def update_learning_rate(self, total_steps):
@@ -101,27 +116,12 @@ class OptimizeWorker:
         weight_path = os.path.join(model_dir, rc.next_generation_model_weight_filename)
         self.model.save(config_path, weight_path)
 
-    def collect_all_loaded_data(self):
-        state_ary_list, policy_ary_list, z_ary_list = [], [], []
-        for s_ary, p_ary, z_ary_ in self.loaded_data.values():
-            state_ary_list.append(s_ary)
-            policy_ary_list.append(p_ary)
-            z_ary_list.append(z_ary_)
-
-        state_ary = np.concatenate(state_ary_list)
-        policy_ary = np.concatenate(policy_ary_list)
-        z_ary = np.concatenate(z_ary_list)
-        return state_ary, policy_ary, z_ary
-
     @property
     def dataset_size(self):
-        if self.dataset is None:
-            return 0
-        return len(self.dataset[0])
+        return len(self.buffer)
 
     def load_model(self):
-        from connect4_zero.agent.model_sequence import Connect4Model
-        model = Connect4Model(self.config)
+        model = SequenceModel(self.config)
         rc = self.config.resource
 
         dirs = get_next_generation_model_dirs(rc)
@@ -138,57 +138,25 @@ class OptimizeWorker:
         return model
 
     def load_play_data(self):
+        """Add play data files not seen yet to the replay buffer; the buffer evicts the oldest records"""
+        tc = self.config.trainer
         filenames = get_game_data_filenames(self.config.resource)
-        updated = False
-        for filename in filenames:
-            if filename in self.loaded_filenames:
-                continue
-            self.load_data_from_file(filename)
-            updated = True
-
-        for filename in (self.loaded_filenames - set(filenames)):
-            self.unload_data_of_file(filename)
-            updated = True
-
-        if updated:
-            logger.debug("updating training dataset")
-            self.dataset = self.collect_all_loaded_data()
-
-    def load_data_from_file(self, filename):
+        new_filenames = [f for f in filenames if os.path.basename(f) not in self.buffer.ingested]
+        added = 0
         try:
-            logger.debug(f"loading data from {filename}")
-            data = read_game_data_from_file(filename)
-            self.loaded_data[filename] = self.convert_to_training_data(data)
-            self.loaded_filenames.add(filename)
-        except Exception as e:
-            logger.warning(str(e))
-
-    def unload_data_of_file(self, filename):
-        logger.debug(f"removing data about {filename} from training set")
-        self.loaded_filenames.remove(filename)
-        if filename in self.loaded_data:
-            del self.loaded_data[filename]
-
-    @staticmethod
-    def convert_to_training_data(data):
-        """
-
-        :param data: format is SelfPlayWorker.buffer
-        :return:
-        """
-        state_list = []
-        policy_list = []
-        z_list = []
-        for state, policy, z in data:
-            board = list(state)
-            board = np.reshape(board, (6, 7))
-            env = Connect4Env().update(board)
-
-            black_ary, white_ary = env.black_and_white_plane()
-            state = [black_ary, white_ary] if env.player_turn() == Player.black else [white_ary, black_ary]
-
-            state_list.append(state)
-            policy_list.append(policy)
-            z_list.append(z)
-
-        return np.array(state_list), np.array(policy_list), np.array(z_list)
+            # decoded in parallel (or read from the cache next to each file), added oldest first
+            prepared = prepare_training_arrays_parallel(new_filenames, tc.replay_policy_entries,
+                                                        tc.convert_process_num)
+        except (OSError, ValueError) as e:
+            logger.warning(f"can not prepare play data in parallel, loading one by one: {e}")
+            prepared = [None] * len(new_filenames)
+        for filename, arrays in zip(new_filenames, prepared):
+            try:
+                added += self.buffer.add_file(filename, arrays)
+            except (OSError, ValueError) as e:
+                logger.warning(f"can not load {filename}: {e}")
+        self.buffer.forget_missing(os.path.basename(filename) for filename in filenames)
+        self.buffer.flush()
+        if added:
+            logger.debug(f"added {added} records to the replay buffer, size={len(self.buffer)}, "
+                         f"merged duplicates={self.buffer.merged}")
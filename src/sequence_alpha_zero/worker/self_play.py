@@ -1,13 +1,18 @@
 import os
 from datetime import datetime
+from glob import glob
 from logging import getLogger
 from time import time
 
+from connect4_zero.agent.api_sequence import Connect4ModelAPI
+from connect4_zero.agent.eval_cache import EvaluationCache
+from connect4_zero.agent.lockstep_player import LockstepPlayer
 from connect4_zero.agent.player_sequence import Connect4Player
 from connect4_zero.config import Config
-from connect4_zero.env.sequence_env import Connect4Env, Winner, Player
+from connect4_zero.env.sequence_env import SequenceEnv, Winner, Player
 from connect4_zero.lib import tf_util
-from connect4_zero.lib.data_helper import get_game_data_filenames, write_game_data_to_file
+from connect4_zero.lib.data_helper import get_game_data_filenames
+from connect4_zero.lib.play_data import PART_SUFFIX, PlayDataWriter, recover_part_file, remove_play_data_file
 from connect4_zero.lib.model_helpler import load_best_model_weight, save_as_best_model, \
     reload_best_model_weight_if_changed
 
@@ -15,95 +20,183 @@ logger = getLogger(__name__)
 
 
 def start(config: Config):
+    if config.opts.workers > 1:
+        from connect4_zero.worker.self_play_pool import SelfPlayPool
+        return SelfPlayPool(config, config.opts.workers).start()
     tf_util.set_session_config(per_process_gpu_memory_fraction=0.2)
-    return SelfPlayWorker(config, env=Connect4Env()).start()
+    if config.opts.lockstep_games > 0:
+        return LockstepSelfPlayWorker(config, env=SequenceEnv()).start()
+    return SelfPlayWorker(config, env=SequenceEnv()).start()
 
 
 class SelfPlayWorker:
-    def __init__(self, config: Config, env=None, model=None):
+    def __init__(self, config: Config, env=None, model=None, api=None,
+                 worker_id=None, game_counter=None, file_lock=None):
         """
 
         :param config:
-        :param Connect4Env|None env:
-        :param connect4_zero.agent.model_connect4.Connect4Model|None model:
+        :param SequenceEnv|None env:
+        :param connect4_zero.agent.model_sequence.SequenceModel|None model:
+        :param connect4_zero.agent.inference_server.InferenceClient|None api: shared inference server;
+            when given, no model is loaded in this process
+        :param int|None worker_id: id within a SelfPlayPool, added to play data file names
+        :param multiprocessing.Value|None game_counter: games finished by the whole pool
+        :param multiprocessing.Lock|None file_lock: serializes play data rotation in the pool
         """
         self.config = config
         self.model = model
-        self.env = env     # type: Connect4Env
-        self.black = None  # type: Connect4Player
-        self.white = None  # type: Connect4Player
-        self.buffer = []
+        self.api = api
+        self.env = env     # type: SequenceEnv
+        self.worker_id = worker_id
+        self.game_counter = game_counter
+        self.file_lock = file_lock
+        self.blue = None  # type: Connect4Player
+        self.red = None  # type: Connect4Player
+        self.writer = None  # type: PlayDataWriter
+        self.cache = None  # type: EvaluationCache
 
     def start(self):
-        if self.model is None:
+        if self.model is None and self.api is None:
             self.model = self.load_model()
+        if self.api is None:  # behind a shared server the weights may change unseen
+            self.cache = EvaluationCache(self.config.play.eval_cache_max_bytes)
+        self.recover_play_data()
 
-        self.buffer = []
         idx = 1
 
         while True:
             start_time = time()
-            env = self.start_game(idx)
+            env = self.start_game()
             end_time = time()
-            logger.debug(f"game {idx} time={end_time - start_time} sec, "
+            total = self.count_finished_game()
+            logger.debug(f"game {idx} (total {total}) time={end_time - start_time} sec, "
                          f"turn={env.turn}:{env.observation} - Winner:{env.winner}")
-            if (idx % self.config.play_data.nb_game_in_file) == 0:
+            if (idx % self.config.play_data.nb_game_in_file) == 0 and self.api is None:
                 reload_best_model_weight_if_changed(self.model)
             idx += 1
 
-    def start_game(self, idx):
+    def start_game(self):
         self.env.reset()
-        self.black = Connect4Player(self.config, self.model)
-        self.white = Connect4Player(self.config, self.model)
+        self.blue = Connect4Player(self.config, self.model, api=self.api, cache=self.cache)
+        self.red = Connect4Player(self.config, self.model, api=self.api, cache=self.cache)
         while not self.env.done:
-            if self.env.player_turn() == Player.black:
-                action = self.black.action(self.env.board)
+            if self.env.mover_stuck():
+                break  # drawn, see SequenceEnv.mover_stuck()
+            if self.env.player_turn() == Player.blue:
+                action = self.blue.action(self.env)
             else:
-                action = self.white.action(self.env.board)
+                action = self.red.action(self.env)
             self.env.step(action)
         self.finish_game()
-        self.save_play_data(write=idx % self.config.play_data.nb_game_in_file == 0)
+        self.save_play_data(self.blue.moves + self.red.moves)
         self.remove_play_data()
         return self.env
 
-    def save_play_data(self, write=True):
-        data = self.black.moves + self.white.moves
-        self.buffer += data
-
-        if not write:
+    def save_play_data(self, moves):
+        """Append a finished game to the play data file, which is closed after nb_game_in_file games"""
+        if self.writer is None:
+            rc = self.config.resource
+            game_id = datetime.now().strftime("%Y%m%d-%H%M%S.%f")
+            if self.worker_id is not None:
+                game_id += f"-w{self.worker_id}"
+            path = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % game_id)
+            self.writer = PlayDataWriter(path, compress=self.config.play_data.compress)
+        self.writer.append_game(moves)
+        if self.writer.game_num >= self.config.play_data.nb_game_in_file:
+            logger.info(f"save play data to {self.writer.path}")
+            self.writer.close()
+            self.writer = None
+
+    def recover_play_data(self):
+        """Finish the play data file an earlier run of this pool worker was writing when it died
+
+        Outside a pool the file names carry no worker id, so an unfinished
+        file may still be in use by another process and is left alone.
+        """
+        if self.worker_id is None:
             return
-
         rc = self.config.resource
-        game_id = datetime.now().strftime("%Y%m%d-%H%M%S.%f")
-        path = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % game_id)
-        logger.info(f"save play data to {path}")
-        write_game_data_to_file(path, self.buffer)
-        self.buffer = []
+        pattern = os.path.join(rc.play_data_dir, rc.play_data_filename_tmpl % f"*-w{self.worker_id}") + PART_SUFFIX
+        for part_path in sorted(glob(pattern)):
+            recover_part_file(part_path)
 
     def remove_play_data(self):
+        if self.file_lock is None:
+            return self._remove_play_data()
+        with self.file_lock:
+            return self._remove_play_data()
+
+    def _remove_play_data(self):
         files = get_game_data_filenames(self.config.resource)
         if len(files) < self.config.play_data.max_file_num:
             return
         for i in range(len(files) - self.config.play_data.max_file_num):
-            os.remove(files[i])
+            try:
+                remove_play_data_file(files[i])
+            except FileNotFoundError:
+                pass  # removed by a self-play process outside this pool
+
+    def count_finished_game(self):
+        if self.game_counter is None:
+            return None
+        with self.game_counter.get_lock():
+            self.game_counter.value += 1
+            return self.game_counter.value
 
     def finish_game(self):
-        if self.env.winner == Winner.black:
-            black_win = 1
-        elif self.env.winner == Winner.white:
-            black_win = -1
+        if self.env.winner == Winner.blue:
+            blue_win = 1
+        elif self.env.winner == Winner.red:
+            blue_win = -1
         else:
-            black_win = 0
+            blue_win = 0
 
-        self.black.finish_game(black_win)
-        self.white.finish_game(-black_win)
+        self.blue.finish_game(blue_win)
+        self.red.finish_game(-blue_win)
 
     def load_model(self):
-        from connect4_zero.agent.model_sequence import Connect4Model
-        model = Connect4Model(self.config)
+        from connect4_zero.agent.model_sequence import SequenceModel
+        model = SequenceModel(self.config)
         if self.config.opts.new or not load_best_model_weight(model):
             model.build()
             save_as_best_model(model)
         return model
 
 
+class LockstepSelfPlayWorker(SelfPlayWorker):
+    """Self-play of config.opts.lockstep_games games at once through LockstepPlayer
+
+    Leaf evaluations of all the games go to the network as one batch.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.idx = 1
+        self.start_time = None
+
+    def start(self):
+        if self.model is None and self.api is None:
+            self.model = self.load_model()
+        api = self.api or Connect4ModelAPI(self.config, self.model)
+        self.recover_play_data()
+
+        self.idx = 1
+        self.start_time = time()
+        player = LockstepPlayer(self.config, api, self.config.opts.lockstep_games)
+        player.run(self.on_game_end)
+
+    def on_game_end(self, slot):
+        """
+        :param connect4_zero.agent.lockstep_player.GameSlot slot: finished game, moves already scored
+        """
+        env = slot.env
+        total = self.count_finished_game()
+        logger.debug(f"game {self.idx} (total {total}) time={time() - self.start_time} sec, "
+                     f"turn={env.turn}:{env.observation} - Winner:{env.winner}")
+        self.start_time = time()
+
+        self.save_play_data(slot.moves[0] + slot.moves[1])
+        if (self.idx % self.config.play_data.nb_game_in_file) == 0 and self.api is None:
+            reload_best_model_weight_if_changed(self.model)
+        self.remove_play_data()
+        self.idx += 1
@@ -0,0 +1,81 @@
+import random
+from collections import Counter
+from logging import getLogger
+from multiprocessing import Lock, Process, Value
+from time import sleep, time
+
+import numpy as np
+
+from connect4_zero.agent.inference_server import start_inference_server
+from connect4_zero.config import Config
+from connect4_zero.env.sequence_env import SequenceEnv
+from connect4_zero.worker.self_play import SelfPlayWorker, LockstepSelfPlayWorker
+
+logger = getLogger(__name__)
+
+SUPERVISE_INTERVAL_SEC = 5
+
+
+def run_worker(config: Config, worker_id, seed, game_counter, file_lock, api):
+    # forked workers inherit the parent's RNG state, so every one gets its own seed
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    logger.debug(f"self-play worker {worker_id} started with seed {seed}")
+    worker_class = LockstepSelfPlayWorker if config.opts.lockstep_games > 0 else SelfPlayWorker
+    worker_class(config, env=SequenceEnv(), api=api, worker_id=worker_id,
+                 game_counter=game_counter, file_lock=file_lock).start()
+
+
+def prepare_best_model(config: Config):
+    """Build and save a best model if needed, in a child so TF never starts in the supervisor"""
+    from connect4_zero.lib import tf_util
+    tf_util.set_session_config(per_process_gpu_memory_fraction=0.2)
+    SelfPlayWorker(config).load_model()
+
+
+class SelfPlayPool:
+    """Runs `worker_num` SelfPlayWorker processes sharing one inference server
+
+    Workers share a finished-game counter and a lock around play data
+    rotation. The supervisor loop restarts any worker that exits.
+    """
+
+    def __init__(self, config: Config, worker_num):
+        self.config = config
+        self.worker_num = worker_num
+        self.game_counter = Value("i", 0)
+        self.file_lock = Lock()
+        self.base_seed = int(time())
+        self.restarts = Counter()
+        self.processes = {}  # worker_id -> Process
+        self.server = None
+        self.clients = []
+
+    def start(self):
+        preparing = Process(target=prepare_best_model, args=(self.config,))
+        preparing.start()
+        preparing.join()
+        if preparing.exitcode != 0:
+            raise RuntimeError("Best model can not prepared!")
+
+        self.server, self.clients = start_inference_server(self.config, self.worker_num)
+        for worker_id in range(self.worker_num):
+            self.start_worker(worker_id)
+
+        while True:
+            sleep(SUPERVISE_INTERVAL_SEC)
+            if not self.server.is_alive():
+                raise RuntimeError(f"inference server exited with {self.server.exitcode}")
+            for worker_id, process in list(self.processes.items()):
+                if not process.is_alive():
+                    logger.warning(f"self-play worker {worker_id} exited with {process.exitcode}, restarting")
+                    self.restarts[worker_id] += 1
+                    self.start_worker(worker_id)
+
+    def start_worker(self, worker_id):
+        seed = self.base_seed + worker_id + self.restarts[worker_id] * self.worker_num
+        process = Process(target=run_worker, name=f"self_play_{worker_id}", daemon=True,
+                          args=(self.config, worker_id, seed, self.game_counter, self.file_lock,
+                                self.clients[worker_id]))
+        process.start()
+        self.processes[worker_id] = process